@@ -1,58 +1,238 @@
-import json
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
+import asyncio
+import logging
+import weakref
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
+from api import renderers
+from api.models import Message
+from api.serializers import CreateMessageSerializer, MessageSerializer
+from api.utilities.eventLog import get_event_log, send_to_user
+from api.utilities.forwardedMessages import MESSAGE_PREFETCH_RELATED, MESSAGE_SELECT_RELATED
+from api.utilities.messageWriter import MessageWriter, create_messages
+from api.utilities.presence import conversation_partners, get_presence
 
+logger = logging.getLogger(__name__)
 
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+def store_messages(drafts):
+    """Flush of the message writer: stores a batch and renders it the way MessageViewSet does."""
+    ids = [message.id for message in create_messages(drafts)]
+    messages = Message.objects.filter(id__in=ids).select_related(
+        *MESSAGE_SELECT_RELATED).prefetch_related(*MESSAGE_PREFETCH_RELATED).in_bulk()
+    data = MessageSerializer([messages[id] for id in ids], many=True).data
+    # Plain JSON types, so the rendered messages can go through the channel layer
+    return renderers.loads(renderers.dumps(data))
+
+
+message_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    loop = asyncio.get_running_loop()
+    if loop not in message_writers:
+        message_writers[loop] = MessageWriter(store_messages)
+    return message_writers[loop]
+
+
+@database_sync_to_async
+def validate_message(user, data):
+    serializer = CreateMessageSerializer(data=data, context={'from_user': user})
+    if serializer.is_valid():
+        return serializer.validated_data, None
+    return None, serializer.errors
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    @classmethod
+    async def decode_json(cls, text_data):
+        return renderers.loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return renderers.dumps(content).decode()
+
+    async def connect(self):
         self.user = self.scope["user"]
 
         if isinstance(self.user, AnonymousUser):
-            self.close()
+            await self.close()
 
         else:
             self.group_name = f'user-{self.user.id}'
-            async_to_sync(self.channel_layer.group_add)(
+            self.pending_sends = set()
+            await self.channel_layer.group_add(
                 self.group_name,
                 self.channel_name
             )
-            self.accept()
+            await self.accept()
+
+            self.partners = await database_sync_to_async(conversation_partners)(self.user.id)
+            if await get_presence().connect(self.user.id, self.channel_name):
+                await self.broadcast_presence(True)
+            self.keep_present_task = asyncio.ensure_future(self.keep_present())
+
+            # Seqs the client already has, skipped when they also arrive through the group
+            self.last_seq = 0
+            self.replayed = set()
+            last_seq = parse_qs(self.scope['query_string'].decode()).get('last_seq')
+            if last_seq and last_seq[0].isdigit():
+                await self.replay(int(last_seq[0]))
+
+    async def receive_json(self, content):
+        frame_type = content.get('type')
+
+        if frame_type == 'send_message':
+            # Persisting waits for the writer's batch, keep reading frames meanwhile
+            task = asyncio.ensure_future(self.send_message(content.get('temp_id'), content.get('message', {})))
+            self.pending_sends.add(task)
+            task.add_done_callback(self.pending_sends.discard)
+            return
 
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
+        if frame_type == 'heartbeat':
+            await get_presence().heartbeat(self.user.id, self.channel_name)
+            return
+
+        if frame_type == 'typing':
+            if content.get('to_user') in self.partners:
+                await self.channel_layer.group_send(f"user-{content['to_user']}", {
+                    'type': 'typing_event',
+                    'user': self.user.id
+                })
+            return
+
+        if frame_type == 'presence':
+            user_ids = [user_id for user_id in content.get('users', []) if user_id in self.partners]
+            await self.send_json({
+                'type': 'presence',
+                'users': await get_presence().online(user_ids)
+            })
+            return
+
+        message = content['message']
         to_user_id = message['to_user']['id']
+        event = {
+            'type': 'chat_message',
+            'message': message
+        }
+
+        await asyncio.gather(*(send_to_user(self.channel_layer, user_id, event)
+                               for user_id in {self.user.id, to_user_id}))
+
+    async def keep_present(self):
+        """
+        Refreshes the socket's presence while it stays open, so clients that
+        never send heartbeat frames aren't taken for offline once it expires.
+        """
+        while True:
+            presence = get_presence()
+            await asyncio.sleep(presence.ttl / 3)
+            try:
+                await presence.heartbeat(self.user.id, self.channel_name)
+            except Exception:
+                logger.exception('Presence of user %s could not be refreshed', self.user.id)
+
+    async def replay(self, last_seq):
+        """Delivers the events logged for the user after `last_seq`, or asks the client to resync when they're gone."""
+        events = await get_event_log().since(self.user.id, last_seq)
+        if events is None:
+            await self.send_json({'type': 'resync'})
+            return
+
+        self.last_seq = last_seq
+        for seq, event in events:
+            await self.dispatch(dict(event, seq=seq))
+            self.replayed.add(seq)
+
+    def delivered(self, seq):
+        """
+        Whether an event was delivered before: the client had it on connect
+        or the replay sent it. Live events can arrive out of seq order, so
+        later seqs don't mark earlier ones as delivered.
+        """
+        if seq in self.replayed:
+            self.replayed.discard(seq)
+            return True
+        return seq <= self.last_seq
+
+    async def send_message(self, temp_id, data):
+        """Stores a message sent over the socket, acknowledges it and delivers the stored version to both users."""
+        validated_data, errors = await validate_message(self.user, data)
+        if errors:
+            await self.send_json({'type': 'ack', 'temp_id': temp_id, 'errors': errors})
+            return
+
+        try:
+            message = await get_message_writer().write(self.user, validated_data)
+        except Exception:
+            await self.send_json({'type': 'ack', 'temp_id': temp_id, 'errors': {'non_field_errors': ['Message could not be saved.']}})
+            return
+
+        await self.send_json({'type': 'ack', 'temp_id': temp_id, 'message': message})
+
+        event = {
+            'type': 'chat_message',
+            'message': message,
+            'stored': True
+        }
+        await asyncio.gather(*(send_to_user(self.channel_layer, user_id, event)
+                               for user_id in {self.user.id, message['to_user']['id']}))
+
+    async def broadcast_presence(self, online):
+        event = {
+            'type': 'presence_event',
+            'user': self.user.id,
+            'online': online
+        }
+        await asyncio.gather(*(self.channel_layer.group_send(f'user-{user_id}', event) for user_id in self.partners))
+
+    async def chat_message(self, event):
+        if self.delivered(event['seq']):
+            return
 
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
-            {
-                'type': 'chat_message',
-                'message': message
-            }
-        )
-
-        async_to_sync(self.channel_layer.group_send)(
-            f'user-{to_user_id}',
-            {
-                'type': 'chat_message',
-                'message': message
-            }
-        )
-
-    def chat_message(self, event):
         message = event['message']
 
-        self.send(text_data=json.dumps({
+        # A stored message may start a conversation, making its users partners for typing and presence.
+        # Relayed messages aren't checked by the server, so they don't count.
+        if event.get('stored'):
+            self.partners.update(message[side]['id'] for side in ('from_user', 'to_user'))
+            self.partners.discard(self.user.id)
+
+        await self.send_json({
             'type': 'message',
-            'message': message
-        }))
-        
+            'message': message,
+            'seq': event['seq']
+        })
+
+    async def thumbnails_event(self, event):
+        if self.delivered(event['seq']):
+            return
+
+        await self.send_json({
+            'type': 'thumbnails',
+            **{key: value for key, value in event.items() if key != 'type'}
+        })
+
+    async def typing_event(self, event):
+        await self.send_json({
+            'type': 'typing',
+            'user': event['user']
+        })
+
+    async def presence_event(self, event):
+        await self.send_json({
+            'type': 'presence',
+            'users': {event['user']: event['online']}
+        })
 
-    def disconnect(self, code):
+    async def disconnect(self, code):
         if not isinstance(self.user, AnonymousUser):
-            async_to_sync(self.channel_layer.group_discard)(
+            if hasattr(self, 'keep_present_task'):
+                self.keep_present_task.cancel()
+            await self.channel_layer.group_discard(
                 self.group_name,
                 self.channel_name
             )
+            if await get_presence().disconnect(self.user.id, self.channel_name):
+                await self.broadcast_presence(False)
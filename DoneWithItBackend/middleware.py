@@ -1,17 +1,38 @@
+import asyncio
+import copy
+from urllib.parse import parse_qs
 from django.contrib.auth.models import AnonymousUser
-from api.models import User
+from api.authentication import CachedJWTAuthentication
+from api.utilities.userCache import load_user, user_cache
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
-from django.conf import settings
-import jwt
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
 
 
-@database_sync_to_async
-def get_user(token_key):
+authentication = CachedJWTAuthentication()
+loading_users = {}
+
+
+async def resolve_user(user_id):
+    """Cached user, or one database read shared by every connection of the user waiting on the same miss."""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    task = loading_users.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(database_sync_to_async(load_user)(user_id))
+        loading_users[user_id] = task
+        task.add_done_callback(lambda task: loading_users.pop(user_id, None))
+    return copy.copy(await asyncio.shield(task))
+
+
+async def get_user(token_key):
     try:
-        user_id: int = jwt.decode(token_key, key=settings.SECRET_KEY, algorithms=['HS256'])['user_id']
-        return User.objects.get(id=user_id) if user_id is not None else AnonymousUser()
-    except:
+        validated_token = authentication.get_validated_token(token_key)
+        user_id = authentication.get_user_id(validated_token)
+        return authentication.check_user(await resolve_user(user_id))
+    except (InvalidToken, AuthenticationFailed):
         return AnonymousUser()
 
 
@@ -20,9 +41,7 @@ class TokenAuthMiddleware(BaseMiddleware):
         super().__init__(inner)
 
     async def __call__(self, scope, receive, send):
-        try:
-            token_key = scope['query_string'].decode().split('=')[-1]
-        except:
-            token_key = None
-        scope['user'] = await get_user(token_key) if token_key is not None else AnonymousUser()
+        query = parse_qs(scope['query_string'].decode())
+        token_key = query.get('token', [None])[0]
+        scope['user'] = await get_user(token_key) if token_key else AnonymousUser()
         return await super().__call__(scope, receive, send)
@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.utils.translation import gettext_lazy as _
 from django.utils.html import format_html
-from .models import Category, Listing, ListingImage, Message, MessageFile, SentOnMessage, User
+from .models import Category, Conversation, ConversationMember, Listing, ListingImage, Message, MessageFile, SentOnMessage, User
 
 
 @admin.register(User)
@@ -65,3 +65,13 @@ class MessageAdmin(admin.ModelAdmin):
 @admin.register(SentOnMessage)
 class SentOnMessageAdmin(admin.ModelAdmin):
     list_display = ['id', 'message_parent', 'message']
+
+class ConversationMemberInLine(admin.TabularInline):
+    model = ConversationMember
+    raw_id_fields = ['last_message']
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ['id', 'first_user', 'second_user', 'last_message_at']
+    raw_id_fields = ['last_message']
+    inlines = [ConversationMemberInLine]
@@ -0,0 +1,63 @@
+import hashlib
+import os
+
+from django.db import models
+from django.db.models.fields.files import FieldFile, ImageFieldFile
+from django.utils.text import get_valid_filename
+
+from .utilities.fileDeletion import file_deletion_queue
+
+
+def content_hash(content):
+    """SHA-256 of a file, from the upload handlers when they already hashed it while it streamed in."""
+    digest = getattr(content, 'sha256', None)
+    if digest is not None:
+        return digest
+
+    hash = hashlib.sha256()
+    for chunk in content.chunks():
+        hash.update(chunk)
+    content.seek(0)
+    return hash.hexdigest()
+
+
+class ContentAddressedFieldFileMixin:
+    """
+    Saves files under the hash of their content, so the same file uploaded
+    again points at the stored object instead of being stored twice. Only
+    the extension of the uploaded name is kept, for content types; rows
+    that need the name a file was sent with store it themselves.
+    """
+
+    def save(self, name, content, save=True):
+        extension = os.path.splitext(get_valid_filename(os.path.basename(name)))[1].lower()[:16]
+        name = self.field.generate_filename(self.instance, content_hash(content) + extension)
+        if self.storage.exists(name):
+            # Its deletion may be queued or running, the object is stored again if it went meanwhile
+            file_deletion_queue.keep(name)
+        if not self.storage.exists(name):
+            name = self.storage.save(name, content, max_length=self.field.max_length)
+
+        self.name = name
+        setattr(self.instance, self.field.attname, self.name)
+        self._committed = True
+
+        if save:
+            self.instance.save()
+    save.alters_data = True
+
+
+class ContentAddressedFieldFile(ContentAddressedFieldFileMixin, FieldFile):
+    pass
+
+
+class ContentAddressedImageFieldFile(ContentAddressedFieldFileMixin, ImageFieldFile):
+    pass
+
+
+class ContentAddressedFileField(models.FileField):
+    attr_class = ContentAddressedFieldFile
+
+
+class ContentAddressedImageField(models.ImageField):
+    attr_class = ContentAddressedImageFieldFile
@@ -1,14 +1,83 @@
-from django_filters.rest_framework import FilterSet
+from django import forms
+from django_filters.rest_framework import BaseCSVFilter, FilterSet, NumberFilter
+from rest_framework.filters import SearchFilter
 from .models import Listing, Message
+from .utilities.listingGeo import filter_bbox, filter_radius
+from .utilities.listingSearch import search_listings
+
+
+class NumberCSVFilter(BaseCSVFilter, NumberFilter):
+    pass
+
+
+def validate_point(latitude, longitude):
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise forms.ValidationError('Latitudes are between -90 and 90, longitudes between -180 and 180.')
+
+
+class ListingFilterForm(forms.Form):
+    def clean(self):
+        data = super().clean()
+        near, radius, bbox = data.get('near'), data.get('radius'), data.get('bbox')
+
+        if near is not None:
+            if len(near) != 2:
+                self.add_error('near', 'Expected latitude,longitude.')
+            else:
+                try:
+                    validate_point(*near)
+                except forms.ValidationError as error:
+                    self.add_error('near', error)
+        if (near is None) != (radius is None):
+            raise forms.ValidationError('near and radius are given together.')
+
+        if bbox is not None:
+            if len(bbox) != 4:
+                self.add_error('bbox', 'Expected min_lat,min_lng,max_lat,max_lng.')
+            else:
+                try:
+                    validate_point(*bbox[:2])
+                    validate_point(*bbox[2:])
+                    if bbox[0] > bbox[2]:
+                        raise forms.ValidationError('min_lat is north of max_lat.')
+                except forms.ValidationError as error:
+                    self.add_error('bbox', error)
+        return data
 
 
 class ListingFilter(FilterSet):
+    # Listings within `radius` km of `near`, nearest first
+    near = NumberCSVFilter(method='filter_by_near', help_text='latitude,longitude')
+    radius = NumberFilter(method='read_by_near', min_value=0, max_value=20_000, help_text='km')
+    # A min_lng east of max_lng is a box across the antimeridian
+    bbox = NumberCSVFilter(method='filter_by_bbox', help_text='min_lat,min_lng,max_lat,max_lng')
+
     class Meta:
         model = Listing
         fields = {
             'category': ['exact'],
             'user': ['exact']
         }
+        form = ListingFilterForm
+
+    def filter_by_near(self, queryset, name, value):
+        return filter_radius(queryset, *value, self.form.cleaned_data['radius'])
+
+    def read_by_near(self, queryset, name, value):
+        return queryset
+
+    def filter_by_bbox(self, queryset, name, value):
+        return filter_bbox(queryset, *value)
+
+
+class ListingSearchFilter(SearchFilter):
+    """The `search` parameter, matched against the listing search vectors and title trigrams and ranked."""
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.search_param, '').strip()
+        if not text:
+            return queryset
+        return search_listings(queryset, text)
 
 # class MessageFilter(django_filters.FilterSet):
 #     class Meta:
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Least
+
+from api.models import Conversation, ConversationMember, Message
+from api.utilities.conversations import get_or_create_conversation, recount_unread, refresh_conversations, refresh_members
+
+
+class Command(BaseCommand):
+    help = 'Creates or refreshes the Conversation rows of every pair of users that exchanged messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of conversations refreshed per transaction.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pairs = Message.objects.annotate(first_user_id=Least('from_user', 'to_user'), second_user_id=Greatest('from_user', 'to_user')) \
+            .values_list('first_user_id', 'second_user_id').order_by('first_user_id', 'second_user_id').distinct()
+
+        total = 0
+        batch = []
+        for pair in pairs.iterator():
+            batch.append(pair)
+            if len(batch) >= batch_size:
+                total += self.backfill(batch)
+                batch = []
+        if batch:
+            total += self.backfill(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {total} conversations.'))
+
+    def backfill(self, pairs):
+        with transaction.atomic():
+            conversation_ids = [get_or_create_conversation(*pair).id for pair in pairs]
+            conversations = Conversation.objects.filter(id__in=conversation_ids)
+
+            refresh_conversations(conversations)
+            members = ConversationMember.objects.filter(conversation_id__in=conversation_ids)
+            refresh_members(members)
+            recount_unread(members)
+            conversations.update(last_activity_at=F('last_message_at'))
+        return len(pairs)
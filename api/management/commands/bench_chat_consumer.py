@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import WebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+
+from api.models import User
+from DoneWithItBackend.consumers import ChatConsumer
+
+
+class SyncChatConsumer(WebsocketConsumer):
+    """The previous thread-pool based consumer, the baseline ChatConsumer is compared against."""
+
+    def connect(self):
+        self.user = self.scope["user"]
+
+        if isinstance(self.user, AnonymousUser):
+            self.close()
+
+        else:
+            self.group_name = f'user-{self.user.id}'
+            async_to_sync(self.channel_layer.group_add)(
+                self.group_name,
+                self.channel_name
+            )
+            self.accept()
+
+    def receive(self, text_data):
+        text_data_json = json.loads(text_data)
+        message = text_data_json['message']
+        to_user_id = message['to_user']['id']
+
+        async_to_sync(self.channel_layer.group_send)(
+            self.group_name,
+            {
+                'type': 'chat_message',
+                'message': message
+            }
+        )
+
+        async_to_sync(self.channel_layer.group_send)(
+            f'user-{to_user_id}',
+            {
+                'type': 'chat_message',
+                'message': message
+            }
+        )
+
+    def chat_message(self, event):
+        message = event['message']
+
+        self.send(text_data=json.dumps({
+            'type': 'message',
+            'message': message
+        }))
+
+    def disconnect(self, code):
+        if not isinstance(self.user, AnonymousUser):
+            async_to_sync(self.channel_layer.group_discard)(
+                self.group_name,
+                self.channel_name
+            )
+
+
+def with_user(application, user):
+    """Stands in for TokenAuthMiddleware so the benchmark measures the consumer only."""
+    async def app(scope, receive, send):
+        return await application(dict(scope, user=user), receive, send)
+    return app
+
+
+class Command(BaseCommand):
+    help = 'Compares connections and frames per second of the async ChatConsumer against the sync one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=500)
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='Every connection sends one frame per round.')
+
+    def handle(self, *args, **options):
+        for consumer in [SyncChatConsumer, ChatConsumer]:
+            connect_rate, frame_rate = asyncio.run(self.bench(consumer, options['connections'], options['rounds']))
+            self.stdout.write(f'{consumer.__name__:>16}: {connect_rate:10.0f} connections/s {frame_rate:10.0f} frames/s')
+
+    async def bench(self, consumer, connections, rounds):
+        application = consumer.as_asgi()
+        users = [User(id=index + 1, name=f'user {index}') for index in range(connections)]
+        communicators = [WebsocketCommunicator(with_user(application, user), '/websocket-server/') for user in users]
+
+        start = time.perf_counter()
+        await asyncio.gather(*(communicator.connect() for communicator in communicators))
+        connect_rate = connections / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await asyncio.gather(*(communicator.send_json_to({
+                'message': {'text': 'benchmark', 'to_user': {'id': users[(index + 1) % connections].id}}
+            }) for index, communicator in enumerate(communicators)))
+            # Every frame is echoed to its sender and delivered to the partner
+            await asyncio.gather(*(self.receive(communicator, 2) for communicator in communicators))
+        frame_rate = connections * rounds / (time.perf_counter() - start)
+
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        return connect_rate, frame_rate
+
+    async def receive(self, communicator, count):
+        for _ in range(count):
+            await communicator.receive_json_from(timeout=30)
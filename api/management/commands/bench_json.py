@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+import decimal
+import json
+import time
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from api.models import Listing, Message
+from api.renderers import ORJSONRenderer, orjson
+from api.serializers import ListingSerializer, MessageSerializer
+from api.utilities.forwardedMessages import MESSAGE_PREFETCH_RELATED, MESSAGE_SELECT_RELATED
+from DoneWithItBackend.consumers import ChatConsumer
+from .bench_serializers import Rollback, seed_pages
+
+# Values that take special care to come out the same as from JSONRenderer
+EDGE_CASES = {
+    'decimal': decimal.Decimal('10.50'),
+    'aware': timezone.now(),
+    'utc': datetime.datetime(2022, 5, 1, 12, 30, tzinfo=datetime.timezone.utc),
+    'naive': datetime.datetime(2022, 5, 1, 12, 30, 15, 500),
+    'date': datetime.date(2022, 5, 1),
+    'lazy': gettext_lazy('This field is required.'),
+    'unicode': 'Привет \u2028\u2029 👋',
+    'int keys': {1: True, 2: False},
+}
+
+
+class Command(BaseCommand):
+    help = 'Compares JSONRenderer against ORJSONRenderer on message and listing pages, and the chat socket codecs with USE_ORJSON on.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            raise CommandError('orjson is not installed, ORJSONRenderer falls back to JSONRenderer.')
+
+        try:
+            # The socket codecs only use orjson once opted in
+            with transaction.atomic(), override_settings(USE_ORJSON=True):
+                self.bench(options['page_size'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def bench(self, page_size, repeat):
+        message_ids, listing_ids = seed_pages(page_size)
+        request = APIRequestFactory().get('/api/messages/')
+        messages = Message.objects.filter(id__in=message_ids).select_related(
+            *MESSAGE_SELECT_RELATED).prefetch_related(*MESSAGE_PREFETCH_RELATED)
+        listings = Listing.objects.filter(id__in=listing_ids).select_related('user').prefetch_related('images')
+
+        pages = [
+            ('messages', {'next': None, 'previous': None,
+                          'results': MessageSerializer(messages, many=True, context={'request': request}).data}),
+            ('listings', {'count': page_size, 'next': None, 'previous': None,
+                          'results': ListingSerializer(listings, many=True, context={'request': request}).data}),
+            ('edge cases', EDGE_CASES),
+        ]
+        for label, data in pages:
+            if JSONRenderer().render(data) != ORJSONRenderer().render(data):
+                raise CommandError(f'ORJSONRenderer output of {label} differs from JSONRenderer')
+
+        for label, data in pages[:2]:
+            stdlib = self.per_call(lambda: JSONRenderer().render(data), repeat)
+            fast = self.per_call(lambda: ORJSONRenderer().render(data), repeat)
+            self.stdout.write(f'{label:>10} page: JSONRenderer {stdlib:8.1f} us, ORJSONRenderer {fast:8.1f} us, {stdlib / fast:.1f}x')
+
+        # Frames carry plain JSON types, as store_messages leaves them
+        frame = {'type': 'message', 'message': json.loads(JSONRenderer().render(pages[0][1]['results'][0])), 'seq': 1}
+        text = json.dumps(frame)
+        for label, before, after in [
+            ('encode', lambda: AsyncJsonWebsocketConsumer.encode_json(frame), lambda: ChatConsumer.encode_json(frame)),
+            ('decode', lambda: AsyncJsonWebsocketConsumer.decode_json(text), lambda: ChatConsumer.decode_json(text)),
+        ]:
+            stdlib = self.per_call(lambda: asyncio.run(self.run_many(before, repeat * 100)), 1) / (repeat * 100)
+            fast = self.per_call(lambda: asyncio.run(self.run_many(after, repeat * 100)), 1) / (repeat * 100)
+            self.stdout.write(f'{label:>10} frame: json {stdlib:8.2f} us, orjson {fast:8.2f} us, {stdlib / fast:.1f}x')
+
+    async def run_many(self, codec, count):
+        for _ in range(count):
+            await codec()
+
+    def per_call(self, call, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            call()
+        return (time.perf_counter() - start) / repeat * 1e6
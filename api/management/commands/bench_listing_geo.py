@@ -0,0 +1,130 @@
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from api.filters import ListingFilter
+from api.management.commands.explain_message_indexes import plan_index_names
+from api.models import Category, Listing, User
+from api.pagination import DefaultPagination
+from api.utilities.listingGeo import haversine_distance, radius_bbox
+
+# Seeded listings crowd around these cities, the rest are spread over the globe
+CITIES = [(55.7558, 37.6173), (59.9343, 30.3351), (40.7128, -74.0060), (51.5074, -0.1278),
+          (35.6762, 139.6503), (-33.8688, 151.2093), (64.8378, -147.7164), (-17.7134, 178.0650)]
+
+
+class Rollback(Exception):
+    pass
+
+
+def scan_radius(queryset, latitude, longitude, radius):
+    """filter_radius without the geo_cell condition, the baseline."""
+    min_lat, min_lng, max_lat, max_lng = radius_bbox(latitude, longitude, radius)
+    if min_lng <= max_lng:
+        longitudes = Q(longitude__range=(min_lng, max_lng))
+    else:
+        longitudes = Q(longitude__gte=min_lng) | Q(longitude__lte=max_lng)
+    return queryset.filter(longitudes, latitude__range=(min_lat, max_lat)).annotate(
+        distance=haversine_distance(latitude, longitude)
+    ).filter(distance__lte=radius).order_by('distance', 'id')
+
+
+class Command(BaseCommand):
+    help = ('Seeds millions of listings inside a transaction and times "near me" queries through ListingFilter '
+            'against the same queries without the geo_cell index, then rolls everything back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--listings', type=int, default=3_000_000)
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--radius', type=float, default=10, help='km')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('The benchmark seeds listings with PostgreSQL generate_series.')
+
+        try:
+            with transaction.atomic():
+                self.seed(options['listings'])
+                self.bench(options['queries'], options['radius'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, listings):
+        self.stdout.write(f'Seeding {listings} listings...')
+        user = User.objects.create(email='bench-geo@example.com', name='bench')
+        category = Category.objects.create(title='bench')
+        cities = json.dumps(CITIES)
+        start = time.perf_counter()
+
+        with connection.cursor() as cursor:
+            # Four in five listings within about 50 km of a city, cells computed as listingGeo.geo_cell does
+            cursor.execute(f"""
+                INSERT INTO {Listing._meta.db_table} (title, price, category_id, user_id, latitude, longitude,
+                                                      geo_cell, description, created_at)
+                SELECT 'listing ' || n, 10, %(category)s, %(user)s, latitude, longitude,
+                       LEAST(floor((latitude + 90) * 10), 1799)::bigint * 3600 +
+                       LEAST(floor((longitude + 180) * 10), 3599)::bigint,
+                       '', now() - random() * interval '365 days'
+                FROM (
+                    SELECT n,
+                           round(GREATEST(LEAST(CASE WHEN near THEN (city ->> 0)::numeric + (random() - 0.5)::numeric
+                                                     ELSE (asin(2 * random() - 1) * 180 / pi())::numeric END, 90), -90), 7)
+                               AS latitude,
+                           round(CASE WHEN near THEN mod((city ->> 1)::numeric + (random() - 0.5)::numeric + 540, 360) - 180
+                                      ELSE (random() * 360 - 180)::numeric END, 7) AS longitude
+                    FROM (
+                        SELECT n, random() < 0.8 AS near,
+                               %(cities)s::jsonb -> floor(random() * jsonb_array_length(%(cities)s::jsonb))::int AS city
+                        FROM generate_series(1, %(listings)s) n
+                    ) seeded
+                ) located
+            """, {'category': category.id, 'user': user.id, 'cities': cities, 'listings': listings})
+            cursor.execute(f'ANALYZE {Listing._meta.db_table}')
+        self.stdout.write(f'Seeded in {time.perf_counter() - start:.1f}s')
+
+    def bench(self, queries, radius):
+        rng = random.Random(0)
+        centers = [(latitude + rng.uniform(-0.3, 0.3), longitude + rng.uniform(-0.3, 0.3))
+                   for latitude, longitude in (rng.choice(CITIES) for _ in range(queries))]
+        queryset = Listing.objects.defer('search_vector')
+        page_size = DefaultPagination.page_size
+
+        def cells(latitude, longitude):
+            filterset = ListingFilter({'near': f'{latitude},{longitude}', 'radius': radius}, queryset=queryset)
+            if not filterset.is_valid():
+                raise CommandError(filterset.errors.as_text())
+            return filterset.qs
+
+        def scan(latitude, longitude):
+            return scan_radius(queryset, latitude, longitude, radius)
+
+        used = set(plan_index_names(json.loads(cells(*centers[0]).explain(format='json'))))
+        self.stdout.write(f'Cell query uses: {", ".join(sorted(used)) or "no index"}')
+        if 'listing_geo_cell_idx' not in used:
+            raise CommandError('The radius query does not use listing_geo_cell_idx.')
+
+        results = {}
+        for label, build in [('geo_cell', cells), ('scan', scan)]:
+            timings, counts = [], []
+            for latitude, longitude in centers:
+                start = time.perf_counter()
+                # As DefaultPagination runs it, a count and the first page
+                listings = build(latitude, longitude)
+                counts.append(listings.count())
+                page = [listing.id for listing in listings[:page_size]]
+                timings.append((time.perf_counter() - start) * 1000)
+                results.setdefault((latitude, longitude), []).append((counts[-1], page))
+
+            timings.sort()
+            self.stdout.write(f'{label:>8}: median {statistics.median(timings):8.1f} ms, '
+                              f'p95 {timings[int(len(timings) * 0.95) - 1]:8.1f} ms, '
+                              f'{statistics.mean(counts):.0f} listings within {radius:g} km on average')
+
+        if any(indexed != scanned for indexed, scanned in results.values()):
+            raise CommandError('The geo_cell query returns different listings than the scan.')
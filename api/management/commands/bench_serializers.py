@@ -0,0 +1,94 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from api.models import Category, Listing, ListingImage, Message, MessageFile, SentOnMessage, User
+from api.serializers import ListingSerializer, MessageSerializer
+from api.utilities.flatSerializers import FlatSerializer
+from api.utilities.forwardedMessages import MESSAGE_PREFETCH_RELATED, MESSAGE_SELECT_RELATED, prefetch_forwarded_messages
+
+
+class Rollback(Exception):
+    pass
+
+
+def seed_pages(page_size):
+    """One page of messages and one of listings covering every nested shape, returns their ids."""
+    users = User.objects.bulk_create([User(email=f'bench-serializer-{index}@example.com', name=f'user {index}',
+                                           avatar=f'api/avatars/{index}.jpg',
+                                           avatar_thumbnail_sm=f'api/avatars/thumbnails/small/{index}.jpg')
+                                      for index in range(2)])
+    category = Category.objects.create(title='bench')
+    listings = Listing.objects.bulk_create([Listing(title=f'listing {index}', price='10.50', category=category,
+                                                    description='description ' * 20, latitude='55.751244',
+                                                    longitude='37.618423', user=users[index % 2])
+                                            for index in range(page_size)])
+    ListingImage.objects.bulk_create([ListingImage(listing=listing, image=f'api/images/{listing.id}-{index}.jpg',
+                                                   thumbnail_card=f'api/images/thumbnails/small/{listing.id}-{index}.jpg',
+                                                   thumbnail_detail=f'api/images/thumbnails/large/{listing.id}-{index}.jpg')
+                                      for listing in listings for index in range(3)])
+
+    messages = []
+    for index in range(page_size):
+        # Mix of plain messages, replies, attached listings, files and forwards
+        message = Message.objects.create(
+            from_user=users[index % 2], to_user=users[(index + 1) % 2], text=f'message {index}',
+            attached_listing=listings[index] if index % 3 == 0 else None,
+            used_for_reply_message=messages[-1] if index % 4 == 1 else None)
+        if index % 5 == 2:
+            MessageFile.objects.create(message=message, file=f'api/files/{index}.pdf')
+        if index % 6 == 3:
+            SentOnMessage.objects.create(message_parent=message, message=messages[-2])
+        messages.append(message)
+    return [message.id for message in messages], [listing.id for listing in listings]
+
+
+class Command(BaseCommand):
+    help = 'Compares per-row cost of the DRF message and listing serializers against their flat versions on one page.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.bench(options['page_size'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def bench(self, page_size, repeat):
+        message_ids, listing_ids = seed_pages(page_size)
+        request = APIRequestFactory().get('/api/messages/')
+        context = {'request': request}
+
+        messages = prefetch_forwarded_messages(Message.objects.filter(id__in=message_ids).select_related(
+            *MESSAGE_SELECT_RELATED).prefetch_related(*MESSAGE_PREFETCH_RELATED))
+        listings = list(Listing.objects.filter(id__in=listing_ids).select_related('user').prefetch_related('images'))
+
+        for label, serializer, rows in [('messages', MessageSerializer(context=context), messages),
+                                        ('listings', ListingSerializer(context=context), listings)]:
+            flat_serializer = FlatSerializer.for_serializer(serializer)
+
+            def drf():
+                return [serializer.to_representation(row) for row in rows]
+
+            def flat():
+                return flat_serializer.many(rows, request)
+
+            if JSONRenderer().render(drf()) != JSONRenderer().render(flat()):
+                raise CommandError(f'Flat {label} output differs from {type(serializer).__name__}')
+
+            drf_cost, flat_cost = self.per_row(drf, len(rows), repeat), self.per_row(flat, len(rows), repeat)
+            self.stdout.write(f'{label}: {type(serializer).__name__} {drf_cost:8.1f} us/row, '
+                              f'flat {flat_cost:8.1f} us/row, {drf_cost / flat_cost:.1f}x')
+
+    def per_row(self, render, rows, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return (time.perf_counter() - start) / repeat / rows * 1e6
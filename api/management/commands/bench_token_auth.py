@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import jwt
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.models import User
+from api.utilities.userCache import user_cache
+from DoneWithItBackend.middleware import TokenAuthMiddleware
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+async def accept(scope, receive, send):
+    pass
+
+
+@database_sync_to_async
+def legacy_get_user(token_key):
+    """How TokenAuthMiddleware resolved users before the cache, as the baseline."""
+    try:
+        user_id = jwt.decode(token_key, key=settings.SECRET_KEY, algorithms=['HS256'])['user_id']
+        return User.objects.get(id=user_id)
+    except (jwt.InvalidTokenError, KeyError, User.DoesNotExist):
+        return AnonymousUser()
+
+
+async def legacy_middleware(scope, receive, send):
+    scope['user'] = await legacy_get_user(scope['query_string'].decode().split('=')[-1])
+
+
+class Command(BaseCommand):
+    help = 'Simulates a WebSocket reconnect storm through TokenAuthMiddleware and reports DB queries per connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--reconnects', type=int, default=10,
+                            help='Connections opened by every user.')
+
+    def handle(self, *args, **options):
+        users = User.objects.bulk_create([User(email=f'bench-token-{index}@example.com', name=f'user {index}')
+                                          for index in range(options['users'])])
+        try:
+            tokens = [str(AccessToken.for_user(user)) for user in users] * options['reconnects']
+
+            for label, middleware in [('before', legacy_middleware), ('cached', TokenAuthMiddleware(accept))]:
+                user_cache.clear()
+                queries, elapsed = asyncio.run(self.storm(middleware, tokens))
+                self.stdout.write(f'{label:>6}: {len(tokens)} connections, {queries} queries, '
+                                  f'{queries / len(tokens):.2f} queries/connection, {len(tokens) / elapsed:.0f} connections/s')
+        finally:
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    async def storm(self, middleware, tokens):
+        counter = QueryCounter()
+        # database_sync_to_async runs every call on the same thread, count queries on its connection
+        await database_sync_to_async(lambda: connection.execute_wrappers.append(counter))()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(middleware({'type': 'websocket', 'query_string': f'token={token}'.encode()}, None, None)
+                               for token in tokens))
+        elapsed = time.perf_counter() - start
+
+        await database_sync_to_async(lambda: connection.execute_wrappers.remove(counter))()
+        return counter.count, elapsed
@@ -0,0 +1,146 @@
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qs, urlparse
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+
+from api.storages import CustomS3Boto3Storage
+
+
+class S3Stub(ThreadingHTTPServer):
+    """
+    Local stand-in for the S3 calls made by uploads: PutObject and the
+    multipart upload calls. Bodies are read and dropped, only their sizes
+    are kept.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), S3StubHandler)
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class S3StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('transfer-encoding') == 'chunked':
+            size = 0
+            while True:
+                chunk_size = int(self.rfile.readline().split(b';')[0], 16)
+                size += len(self.rfile.read(chunk_size + 2)) - 2 if chunk_size else 0
+                if not chunk_size:
+                    # Trailers, up to the closing empty line
+                    while self.rfile.readline() not in (b'\r\n', b''):
+                        pass
+                    return size
+
+        size = int(self.headers.get('content-length', 0))
+        remaining = size
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        # aws-chunked bodies carry the payload length separately
+        return int(self.headers.get('x-amz-decoded-content-length', size))
+
+    def do_PUT(self):
+        key = urlparse(self.path).path
+        size = self.read_body()
+        with self.server.lock:
+            self.server.sizes[key] = self.server.sizes.get(key, 0) + size
+        self.reply(200, b'', {'ETag': f'"{uuid.uuid4().hex}"'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.read_body()
+        query = parse_qs(url.query, keep_blank_values=True)
+        if 'uploads' in query:
+            content = f'<InitiateMultipartUploadResult><Bucket>bench</Bucket><Key>{url.path}</Key>' \
+                      f'<UploadId>{uuid.uuid4().hex}</UploadId></InitiateMultipartUploadResult>'
+        else:
+            content = f'<CompleteMultipartUploadResult><Bucket>bench</Bucket><Key>{url.path}</Key>' \
+                      f'<ETag>"{uuid.uuid4().hex}"</ETag></CompleteMultipartUploadResult>'
+        self.reply(200, content.encode(), {'Content-Type': 'application/xml'})
+
+    def reply(self, status, content, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class CopyingS3Boto3Storage(CustomS3Boto3Storage):
+    """The previous save path, copying every upload in memory first, as the baseline."""
+
+    def _save(self, name, content):
+        content.seek(0)
+        with SpooledTemporaryFile() as content_autoclose:
+            content_autoclose.write(content.read())
+            return super()._save(name, content_autoclose)
+
+
+class Command(BaseCommand):
+    help = 'Uploads large files concurrently to a local S3 stand-in and checks peak memory against a ceiling.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=4)
+        parser.add_argument('--size', type=int, default=100, help='Size of every file in MB.')
+
+    def handle(self, *args, **options):
+        stub = S3Stub()
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+        size = options['size'] * 1024 * 1024
+        config = CustomS3Boto3Storage.transfer_config
+        # Parts held in memory by every upload, plus room for boto3 itself
+        ceiling = options['files'] * config.max_in_memory_upload_chunks * config.multipart_chunksize + 16 * 1024 * 1024
+
+        try:
+            for storage_class in [CopyingS3Boto3Storage, CustomS3Boto3Storage]:
+                storage = storage_class(bucket_name='bench', endpoint_url=stub.url, access_key='bench',
+                                        secret_key='bench', region_name='us-east-1', addressing_style='path',
+                                        default_acl=None, querystring_auth=False)
+                peak, elapsed = self.upload(storage, options['files'], size)
+                self.stdout.write(f'{storage_class.__name__:>21}: {options["files"]} x {options["size"]} MB in {elapsed:.1f}s, '
+                                  f'peak {peak / 1024 / 1024:.0f} MB')
+        finally:
+            stub.shutdown()
+
+        if peak > ceiling:
+            raise CommandError(f'Peak memory {peak / 1024 / 1024:.0f} MB over the {ceiling / 1024 / 1024:.0f} MB ceiling')
+        if any(uploaded != size for uploaded in list(stub.sizes.values())[-options['files']:]):
+            raise CommandError('Uploaded sizes differ from the files')
+
+    def upload(self, storage, files, size):
+        uploads = []
+        for index in range(files):
+            upload = TemporaryUploadedFile(f'large-{index}.bin', 'application/octet-stream', size, None)
+            # Sparse, so the files cost no disk writes
+            upload.file.truncate(size)
+            uploads.append(upload)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(files) as executor:
+                list(executor.map(lambda upload: storage.save(f'api/files/{uuid.uuid4().hex}.bin', upload), uploads))
+            return tracemalloc.get_traced_memory()[1], time.perf_counter() - start
+        finally:
+            tracemalloc.stop()
+            for upload in uploads:
+                upload.close()
@@ -0,0 +1,110 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from api.models import Message, User
+from api.views import prefRelMessages
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Seeds a large message dataset inside a transaction, checks with EXPLAIN that the message '
+            'queries use the visibility and pair indexes, then rolls everything back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2_000_000)
+        parser.add_argument('--users', type=int, default=20_000)
+        parser.add_argument('--partners', type=int, default=10,
+                            help='Number of users each seeded user chats with.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('The message indexes are PostgreSQL partial indexes.')
+
+        try:
+            with transaction.atomic():
+                user_id, other_user_id = self.seed(options['users'], options['partners'], options['messages'])
+                failures = self.check_plans(user_id, other_user_id)
+                raise Rollback
+        except Rollback:
+            pass
+
+        if failures:
+            raise CommandError('\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('All message queries use the expected indexes.'))
+
+    def seed(self, users, partners, messages):
+        self.stdout.write(f'Seeding {users} users and {messages} messages...')
+        user_table = User._meta.db_table
+        message_table = Message._meta.db_table
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {user_table} (password, is_superuser, first_name, last_name, is_staff, is_active, date_joined, name, email)
+                SELECT '', false, '', '', false, true, now(), 'user ' || n, 'explain-' || n || '@example.com'
+                FROM generate_series(1, %s) n
+                RETURNING id
+            """, [users])
+            user_ids = [row[0] for row in cursor.fetchall()]
+            first_id, last_id = min(user_ids), max(user_ids)
+            if last_id - first_id + 1 != len(user_ids):
+                raise CommandError('Seeded user ids are not contiguous.')
+
+            cursor.execute(f"""
+                INSERT INTO {message_table} (from_user_id, to_user_id, text, sent_at, is_deleted_for_from_user,
+                                             is_deleted_for_to_user, is_edited, is_read)
+                SELECT %(first)s + sender,
+                       %(first)s + (sender + 1 + floor(random() * %(partners)s)::int) %% %(users)s,
+                       'message ' || n,
+                       now() - (random() * interval '365 days'),
+                       random() < 0.05, random() < 0.05, false, random() < 0.9
+                FROM (
+                    SELECT n, floor(random() * %(users)s)::int AS sender FROM generate_series(1, %(messages)s) n
+                ) seeded
+            """, {'first': first_id, 'users': len(user_ids), 'partners': partners, 'messages': messages})
+            cursor.execute(f'ANALYZE {user_table}')
+            cursor.execute(f'ANALYZE {message_table}')
+
+            # The busiest pair of users makes the chatView check realistic
+            cursor.execute(f"""
+                SELECT from_user_id, to_user_id FROM {message_table}
+                WHERE from_user_id BETWEEN %s AND %s AND from_user_id <> to_user_id
+                GROUP BY from_user_id, to_user_id ORDER BY count(*) DESC LIMIT 1
+            """, [first_id, last_id])
+            return cursor.fetchone()
+
+    def check_plans(self, user_id, other_user_id):
+        visible = prefRelMessages(user_id)
+        checks = [
+            ('list', visible.order_by('-sent_at', '-id')[:100],
+             {'message_from_visible_idx', 'message_to_visible_idx'}),
+            ('chatView', visible.filter(Q(from_user__id=user_id, to_user__id__in=[other_user_id]) |
+                                        Q(from_user__id__in=[other_user_id], to_user__id=user_id))
+             .order_by('-sent_at', '-id')[:100],
+             {'message_pair_idx'}),
+        ]
+
+        failures = []
+        for name, queryset, expected in checks:
+            used = set(plan_index_names(json.loads(queryset.explain(format='json'))))
+            self.stdout.write(f'{name}: {", ".join(sorted(used)) or "no index"}')
+            if not expected <= used:
+                failures.append(f'{name} does not use {", ".join(sorted(expected - used))}')
+        return failures
+
+
+def plan_index_names(plan):
+    if isinstance(plan, list):
+        for item in plan:
+            yield from plan_index_names(item)
+    elif isinstance(plan, dict):
+        if 'Index Name' in plan:
+            yield plan['Index Name']
+        for value in plan.values():
+            if isinstance(value, (list, dict)):
+                yield from plan_index_names(value)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Message
+from api.utilities.messageSearch import update_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the full-text search vector of every message visible to at least one of its users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of messages loaded per query.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        messages = Message.objects.exclude(is_deleted_for_from_user=True, is_deleted_for_to_user=True).order_by('id')
+
+        total = 0
+        last_id = 0
+        while True:
+            batch = list(messages.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not batch:
+                break
+            update_search_vectors(Message.objects.filter(id__in=batch))
+            total += len(batch)
+            last_id = batch[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} messages.'))
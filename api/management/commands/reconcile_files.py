@@ -0,0 +1,77 @@
+import datetime
+import os
+
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.utils import timezone
+
+from api.utilities.fileDeletion import delete_many, file_deletion_queue, storage_key
+
+
+def walk_storage(storage, prefix):
+    """(name, modified, size) of every stored file under `prefix`, with one paginated listing on S3."""
+    if hasattr(storage, 'bucket'):
+        location = storage_key(storage, '')
+        for obj in storage.bucket.objects.filter(Prefix=storage_key(storage, prefix)):
+            yield obj.key[len(location):].lstrip('/'), obj.last_modified, obj.size
+        return
+
+    for directory, _, files in os.walk(storage.path(prefix)):
+        for file in files:
+            path = os.path.join(directory, file)
+            stat = os.stat(path)
+            name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+            yield name, datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc), stat.st_size
+
+
+class Command(BaseCommand):
+    help = 'Drains the file deletion queue, then finds stored files no row references and, with --delete, deletes them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='api/')
+        parser.add_argument('--min-age', type=float, default=24,
+                            help='Hours a file must be stored before it counts as orphaned, for uploads not saved yet.')
+        parser.add_argument('--delete', action='store_true')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Queue again the deletions given up on after too many failed attempts.')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            file_deletion_queue.failed().update(attempts=0)
+        file_deletion_queue.drain()
+
+        failed = list(file_deletion_queue.failed().order_by('id').values_list('name', flat=True))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{len(failed)} queued deletions failed '
+                                                 f'{file_deletion_queue.max_attempts} times, retry with --retry-failed:'))
+            for name in failed[:20]:
+                self.stdout.write(f'  {name}')
+
+        # Listed before the references are read, so files saved meanwhile are referenced by then
+        cutoff = timezone.now() - datetime.timedelta(hours=options['min_age'])
+        stored = {name: size for name, modified, size in walk_storage(default_storage, options['prefix'])
+                  if modified < cutoff}
+        referenced = self.referenced_names()
+        orphans = sorted(name for name in stored if name not in referenced)
+
+        self.stdout.write(f'{len(stored)} stored files older than {options["min_age"]:g}h, {len(orphans)} orphaned, '
+                          f'{sum(stored[name] for name in orphans) / 1024 / 1024:.1f} MB')
+        for name in orphans[:20]:
+            self.stdout.write(f'  {name}')
+
+        if options['delete'] and orphans:
+            failed = []
+            for start in range(0, len(orphans), file_deletion_queue.batch_size):
+                failed += delete_many(default_storage, orphans[start:start + file_deletion_queue.batch_size])
+            self.stdout.write(f'{len(orphans) - len(failed)} deleted, {len(failed)} failed')
+
+    def referenced_names(self):
+        names = set()
+        for model in apps.get_models():
+            for field in model._meta.concrete_fields:
+                if isinstance(field, models.FileField) and field.storage is default_storage:
+                    names.update(model.objects.exclude(**{field.attname: ''}).exclude(**{f'{field.attname}__isnull': True})
+                                 .values_list(field.attname, flat=True).iterator(chunk_size=10000))
+        return names
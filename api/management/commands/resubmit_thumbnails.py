@@ -0,0 +1,33 @@
+from concurrent.futures import wait
+
+from django.core.management.base import BaseCommand
+
+from api.utilities.thumbnails import THUMBNAILS, thumbnail_pipeline
+
+
+class Command(BaseCommand):
+    help = ('Makes the thumbnails of every row still missing them, such as rows whose job was lost '
+            'to a restart or failed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of rows submitted to the pipeline at a time.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        for model_label in THUMBNAILS:
+            rows = thumbnail_pipeline.missing(model_label).order_by('pk')
+            made = failed = 0
+            last_pk = 0
+            while True:
+                batch = list(rows.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+                if not batch:
+                    break
+                done, _ = wait(thumbnail_pipeline.submit(model_label, batch))
+                # None when the job failed or the source changed meanwhile
+                made += sum(future.result() is not None for future in done)
+                failed += sum(future.result() is None for future in done)
+                last_pk = batch[-1]
+
+            self.stdout.write(f'{model_label}: {made} rows got thumbnails, {failed} did not')
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0038_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='conversationmember',
+            index=models.Index(condition=models.Q(('unread_count__gt', 0)), fields=['user'], name='conversation_member_unread_idx'),
+        ),
+    ]
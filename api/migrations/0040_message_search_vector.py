@@ -0,0 +1,27 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:14
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # The index is built without locking writes
+    atomic = False
+
+    dependencies = [
+        ('api', '0039_conversationmember_unread_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='message_search_vector_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:15
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('api', '0040_message_search_vector'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_deleted_for_from_user', False)), fields=['from_user', '-sent_at', '-id'], name='message_from_visible_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_deleted_for_to_user', False)), fields=['to_user', '-sent_at', '-id'], name='message_to_visible_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['from_user', 'to_user', '-sent_at', '-id'], name='message_pair_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:49
+
+import api.fields
+import api.validators
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0041_message_visibility_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='listingimage',
+            name='image',
+            field=api.fields.ContentAddressedImageField(max_length=255, upload_to='api/images', validators=[api.validators.validate_file_size]),
+        ),
+        migrations.AlterField(
+            model_name='messagefile',
+            name='file',
+            field=api.fields.ContentAddressedFileField(max_length=255, upload_to='api/messageFiles', validators=[api.validators.validate_file_size]),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='avatar',
+            field=api.fields.ContentAddressedImageField(blank=True, max_length=255, null=True, upload_to='api/avatars', validators=[api.validators.validate_file_size]),
+        ),
+    ]
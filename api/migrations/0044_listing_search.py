@@ -0,0 +1,43 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:54
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.operations
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # The indexes are built without locking writes, the vectors are filled in before
+    atomic = False
+
+    dependencies = [
+        ('api', '0043_pending_file_deletion'),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.TrigramExtension(),
+        migrations.AddField(
+            model_name='listing',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        # Vectors of the existing listings, as update_listing_search_vectors computes them for new ones
+        migrations.RunSQL(
+            """
+            UPDATE api_listing SET search_vector =
+                setweight(to_tsvector('simple', COALESCE(api_listing.title, '')), 'A') ||
+                setweight(to_tsvector('simple', COALESCE(api_listing.description, '')), 'B') ||
+                setweight(to_tsvector('simple', COALESCE(api_user.name, '')), 'C')
+            FROM api_user WHERE api_user.id = api_listing.user_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        django.contrib.postgres.operations.AddIndexConcurrently(
+            model_name='listing',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='listing_search_vector_idx'),
+        ),
+        django.contrib.postgres.operations.AddIndexConcurrently(
+            model_name='listing',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['title'], name='listing_title_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:57
+
+import django.core.validators
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The index is built without locking writes
+    atomic = False
+
+    dependencies = [
+        ('api', '0044_listing_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='geo_cell',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='listing',
+            name='latitude',
+            field=models.DecimalField(blank=True, decimal_places=7, max_digits=10, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AlterField(
+            model_name='listing',
+            name='longitude',
+            field=models.DecimalField(blank=True, decimal_places=7, max_digits=10, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        # Cells of the existing listings, as listingGeo.geo_cell computes them, before the index is built
+        migrations.RunSQL(
+            """
+            UPDATE api_listing SET geo_cell =
+                LEAST(GREATEST(floor((latitude + 90) * 10), 0), 1799)::bigint * 3600 +
+                LEAST(GREATEST(floor((longitude + 180) * 10), 0), 3599)::bigint
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            """,
+            migrations.RunSQL.noop,
+        ),
+        AddIndexConcurrently(
+            model_name='listing',
+            index=models.Index(fields=['geo_cell', 'latitude', 'longitude'], name='listing_geo_cell_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 20:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0045_listing_geo_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagefile',
+            name='name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        # Files stored so far keep the last part of their name
+        migrations.RunSQL(
+            "UPDATE api_messagefile SET name = regexp_replace(file, '^.*/', '')",
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
-from django.core.validators import MinValueValidator
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
@@ -7,6 +9,7 @@ from imagekit.models import ProcessedImageField
 from imagekit.processors import SmartResize
 
 from . import signals
+from .fields import ContentAddressedFileField, ContentAddressedImageField
 from .managers import UserManager
 from api.validators import validate_file_size
 
@@ -15,7 +18,7 @@ class User(AbstractUser):
     name = models.CharField(max_length=255)
     username = None
     email = models.EmailField(_('email address'), unique=True)
-    avatar = models.ImageField(upload_to='api/avatars', validators=[validate_file_size], null=True, blank=True)
+    avatar = ContentAddressedImageField(upload_to='api/avatars', max_length=255, validators=[validate_file_size], null=True, blank=True)
     avatar_thumbnail_sm = ProcessedImageField(upload_to='api/avatars/thumbnails/small', format='JPEG', processors=[
                                          SmartResize(300, 300)], null=True, blank=True)
 
@@ -50,18 +53,34 @@ class Listing(models.Model):
         max_digits=10,
         decimal_places=7,
         null=True,
-        blank=True
+        blank=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)]
     )
     longitude = models.DecimalField(
         max_digits=10,
         decimal_places=7,
         null=True,
-        blank=True
+        blank=True,
+        validators=[MinValueValidator(-180), MaxValueValidator(180)]
     )
+    # Grid cell of the location, from listingGeo.geo_cell, for radius and bounding box queries
+    geo_cell = models.BigIntegerField(null=True, editable=False)
 
     description = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True)
 
+    # Weighted title, description and seller name, kept up to date by update_listing_search_vectors
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='listing_search_vector_idx'),
+            # Word similarity of titles, for searches with typos
+            GinIndex(fields=['title'], opclasses=['gin_trgm_ops'], name='listing_title_trgm_idx'),
+            # Coordinates included, so the exact bounds are checked in the index before rows are read
+            models.Index(fields=['geo_cell', 'latitude', 'longitude'], name='listing_geo_cell_idx'),
+        ]
+
     def __str__(self) -> str:
         return self.title
 
@@ -69,13 +88,17 @@ class Listing(models.Model):
 class ListingImage(models.Model):
     listing = models.ForeignKey(
         Listing, on_delete=models.CASCADE, related_name='images')
-    image = models.ImageField(upload_to='api/images',
+    image = ContentAddressedImageField(upload_to='api/images', max_length=255,
                               validators=[validate_file_size])
     thumbnail_card = ProcessedImageField(upload_to='api/images/thumbnails/small', format='JPEG', processors=[
                                          SmartResize(800, 400)], null=True, blank=True)
     thumbnail_detail = ProcessedImageField(
         upload_to='api/images/thumbnails/large', format='JPEG', processors=[SmartResize(900, 900)], null=True, blank=True)
 
+    @property
+    def thumbnails_pending(self):
+        return not self.thumbnail_card or not self.thumbnail_detail
+
 
 
 class Message(models.Model):
@@ -95,13 +118,30 @@ class Message(models.Model):
     is_edited = models.BooleanField(default=False)
     is_read = models.BooleanField(default=False)
 
+    # Maintained by api.utilities.messageSearch
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='message_search_vector_idx'),
+            # One partial index per side of the visibility filter used by prefRelMessages
+            models.Index(fields=['from_user', '-sent_at', '-id'], condition=models.Q(is_deleted_for_from_user=False),
+                         name='message_from_visible_idx'),
+            models.Index(fields=['to_user', '-sent_at', '-id'], condition=models.Q(is_deleted_for_to_user=False),
+                         name='message_to_visible_idx'),
+            # Messages between two users, in both directions, for chatView and conversation refreshes
+            models.Index(fields=['from_user', 'to_user', '-sent_at', '-id'], name='message_pair_idx'),
+        ]
+
     def __str__(self) -> str:
         return self.text
 
 class MessageFile(models.Model):
     message = models.ForeignKey(
         Message, on_delete=models.CASCADE, related_name="files")
-    file = models.FileField(upload_to="api/messageFiles", validators=[validate_file_size])
+    file = ContentAddressedFileField(upload_to="api/messageFiles", max_length=255, validators=[validate_file_size])
+    # Name the file was sent with, the stored object is named after its content
+    name = models.CharField(max_length=255, blank=True)
 
 
 class SentOnMessage(models.Model):
@@ -115,3 +155,61 @@ class SentOnMessage(models.Model):
 
     def __str__(self) -> str:
         return "Пересланное сообщение"
+
+
+class Conversation(models.Model):
+    """One row per pair of users that exchanged messages, first_user being the one with the lower id."""
+    first_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    second_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, related_name='+', null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_activity_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['first_user', 'second_user'], name='unique_conversation_users'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.first_user_id} - {self.second_user_id}'
+
+
+class ConversationMember(models.Model):
+    """A user's side of a conversation. The chat is hidden for the user while last_message is null."""
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name='members')
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='conversations')
+    last_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, related_name='+', null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='unique_conversation_member'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at', '-id'], name='conversation_member_list_idx'),
+            models.Index(fields=['user'], condition=models.Q(unread_count__gt=0), name='conversation_member_unread_idx'),
+        ]
+
+
+class PendingFileDeletion(models.Model):
+    """A stored file that lost its last reference, deleted by the file deletion queue unless a row uses it again."""
+    model = models.CharField(max_length=100)
+    field = models.CharField(max_length=100)
+    name = models.CharField(max_length=255)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['model', 'field', 'name'], name='unique_pending_file_deletion'),
+        ]
+
+    def __str__(self) -> str:
+        return self.name
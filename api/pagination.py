@@ -1,7 +1,111 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 class DefaultPagination(PageNumberPagination):
     page_size = 30
 
 class MessagePagination(PageNumberPagination):
-    page_size = 100
\ No newline at end of file
+    page_size = 100
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over (sent_at, id), newest messages first.
+
+    Pages are fetched with an indexed range condition instead of COUNT + OFFSET,
+    so deep scrollback costs the same as the first page. Start with `?cursor=`
+    and follow the `next` (older) and `previous` (newer) links, or load around
+    a message with `?before=<message id>` / `?after=<message id>`.
+    """
+    page_size = 100
+    cursor_query_param = 'cursor'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+    invalid_anchor_message = 'Anchor message not found'
+
+    @classmethod
+    def is_requested(cls, request):
+        return any(param in request.query_params for param in (
+            cls.cursor_query_param, cls.before_query_param, cls.after_query_param))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        position, newer = self.get_position(queryset, request)
+
+        if position is None:
+            page = list(queryset.order_by('-sent_at', '-id')[:self.page_size + 1])
+            self.has_older = len(page) > self.page_size
+            self.has_newer = False
+        elif newer:
+            sent_at, pk = position
+            page = list(queryset.filter(Q(sent_at__gt=sent_at) | Q(sent_at=sent_at, id__gt=pk))
+                        .order_by('sent_at', 'id')[:self.page_size + 1])
+            self.has_newer = len(page) > self.page_size
+            self.has_older = True
+        else:
+            sent_at, pk = position
+            page = list(queryset.filter(Q(sent_at__lt=sent_at) | Q(sent_at=sent_at, id__lt=pk))
+                        .order_by('-sent_at', '-id')[:self.page_size + 1])
+            self.has_older = len(page) > self.page_size
+            self.has_newer = True
+
+        self.page = page[:self.page_size]
+        if newer:
+            self.page.reverse()
+        return self.page
+
+    def get_position(self, queryset, request):
+        """Returns ((sent_at, id), newer) to paginate from, or (None, False) for the newest page."""
+        for param, newer in ((self.before_query_param, False), (self.after_query_param, True)):
+            anchor = request.query_params.get(param)
+            if anchor:
+                try:
+                    return queryset.values_list('sent_at', 'id').get(pk=int(anchor)), newer
+                except (ValueError, queryset.model.DoesNotExist):
+                    raise NotFound(self.invalid_anchor_message)
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        return self.decode_cursor(encoded)
+
+    def decode_cursor(self, encoded):
+        try:
+            direction, sent_at, pk = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            sent_at = parse_datetime(sent_at)
+            if direction not in ('n', 'o') or sent_at is None:
+                raise ValueError
+            return (sent_at, int(pk)), direction == 'n'
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, message, newer):
+        cursor = '|'.join(['n' if newer else 'o', message.sent_at.isoformat(), str(message.id)])
+        url = remove_query_param(self.base_url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, self.cursor_query_param, urlsafe_b64encode(cursor.encode('ascii')).decode('ascii'))
+
+    def get_next_link(self):
+        if not self.has_older or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], newer=False)
+
+    def get_previous_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], newer=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
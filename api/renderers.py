@@ -0,0 +1,73 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+encoder = JSONEncoder()
+
+if orjson is not None:
+    # Dates go through DRF's encoder too, so they keep its format ('Z' for UTC)
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def use_orjson():
+    return orjson is not None and settings.USE_ORJSON
+
+
+def orjson_dumps(data):
+    """
+    JSON bytes of `data` through orjson, the same as JSONRenderer renders
+    them. Types orjson doesn't know, like Decimal, datetimes and lazy
+    translation strings, are converted by DRF's encoder.
+    """
+    # Escaped like JSONRenderer does, to stay a strict JavaScript subset
+    return orjson.dumps(data, default=encoder.default, option=ORJSON_OPTIONS) \
+        .replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+def dumps(data):
+    """JSON bytes of `data` as JSONRenderer renders them, through orjson when USE_ORJSON is set."""
+    if not use_orjson():
+        return JSONRenderer().render(data)
+    return orjson_dumps(data)
+
+
+def loads(data):
+    if not use_orjson():
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """JSONRenderer through orjson. Indented and ASCII-only output are left to JSONRenderer."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if orjson is None or indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson_dumps(data)
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
@@ -1,4 +1,5 @@
-from django.db import transaction
+from django.core.files.storage import default_storage
+from django.db import models, transaction
 from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
@@ -6,7 +7,16 @@ from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from djoser.serializers import UserSerializer as BaseUserSerializer, UserCreateSerializer as BaseUserCreateSerializer
 
 from .models import Category, Listing, ListingImage, Message, MessageFile, SentOnMessage, User
-from .utilities.pushNotifications import send_push_message
+from .utilities.conversations import discount_unread, record_deletion, record_edit
+from .utilities.directUploads import UPLOAD_KINDS, load_upload_token, presign_upload, validate_upload_keys
+from .utilities.flatSerializers import FlatSerializer
+from .utilities.forwardedMessages import load_messages, prefetch_forwarded_messages
+from .utilities.listingGeo import geo_cell
+from .utilities.listingSearch import update_listing_search_vectors
+from .utilities.messageSearch import clear_search_vectors, update_search_vectors
+from .utilities.messageWriter import create_messages
+from .utilities.renderCache import render_cache
+from .utilities.thumbnails import thumbnail_pipeline
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
@@ -18,6 +28,8 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         token['email'] = user.email
         if user.avatar:
             token['avatar'] = user.avatar.url
+        # Empty until the thumbnail pipeline makes it
+        if user.avatar_thumbnail_sm:
             token['avatar_thumbnail_sm'] = user.avatar_thumbnail_sm.url
 
         return token
@@ -32,7 +44,24 @@ class UserCreateSerializer(BaseUserCreateSerializer):
 class UserSerializer(BaseUserSerializer):
     class Meta(BaseUserSerializer.Meta):
         fields = ['id', 'name', 'email', 'avatar', 'avatar_thumbnail_sm']
-        
+        read_only_fields = ['avatar_thumbnail_sm']
+
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            # The thumbnail of a new avatar is pending until the pipeline made it
+            if 'avatar' in validated_data:
+                instance.avatar_thumbnail_sm = None
+            name_changed = validated_data.get('name', instance.name) != instance.name
+            instance = super().update(instance, validated_data)
+            # The name is part of the search vectors of their listings and of the messages showing it
+            if name_changed:
+                update_listing_search_vectors(Listing.objects.filter(user=instance))
+                update_search_vectors(Message.objects.filter(
+                    Q(from_user=instance) | Q(to_user=instance) | Q(used_for_reply_message__from_user=instance) |
+                    Q(attached_listing__user=instance)))
+            if 'avatar' in validated_data and instance.avatar:
+                thumbnail_pipeline.submit_on_commit('api.User', [instance.pk])
+        return instance
 
 
 class UserExpoTokenSerializer(BaseUserSerializer):
@@ -58,20 +87,31 @@ class UserExpoTokenSerializer(BaseUserSerializer):
 class ListingImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ListingImage
-        fields = ['id', 'image', 'thumbnail_card', 'thumbnail_detail']
+        fields = ['id', 'image', 'thumbnail_card', 'thumbnail_detail', 'thumbnails_pending']
         read_only_fields = ['thumbnail_card', 'thumbnail_detail']
 
+    thumbnails_pending = serializers.BooleanField(read_only=True)
+
     def save(self, **kwargs):
-        image = ListingImage.objects.create(
-            **self.validated_data, listing_id=self.context['listing_id'])
+        with transaction.atomic():
+            image = ListingImage.objects.create(
+                **self.validated_data, listing_id=self.context['listing_id'])
+            thumbnail_pipeline.submit_on_commit('api.ListingImage', [image.pk])
         return image
 
 
+class ListingListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        return FlatSerializer.for_serializer(self.child).many(iterable, self.context.get('request'))
+
+
 class ListingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Listing
         fields = ['id', 'title', 'images', 'price',
                   'category', 'user', 'location', 'description', 'created_at']
+        list_serializer_class = ListingListSerializer
 
     user = UserSerializer()
     images = ListingImageSerializer(many=True)
@@ -85,11 +125,17 @@ class ListingSerializer(serializers.ModelSerializer):
 class CreateListingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Listing
-        fields = ['id', 'title', 'images', 'price',
+        fields = ['id', 'title', 'images', 'image_keys', 'price',
                   'category', 'latitude', 'longitude', 'description']
 
     images = serializers.ListField(
         child=serializers.ImageField(), default=[], allow_empty=True, write_only=True)
+    # Keys of images uploaded through a presigned upload
+    image_keys = serializers.ListField(
+        child=serializers.CharField(), default=[], allow_empty=True, write_only=True)
+
+    def validate_image_keys(self, value):
+        return validate_upload_keys('listingImage', value, self.context['user_id'])
 
     def save(self, **kwargs):
         with transaction.atomic():
@@ -104,27 +150,83 @@ class CreateListingSerializer(serializers.ModelSerializer):
 
             try:
                 listing = Listing.objects.get(pk=pk)
+                search_text_changed = (listing.title, listing.description) != (title, description)
                 listing.title = title
                 listing.price = price
                 listing.category = category
                 listing.description = description
                 listing.latitude = latitude
                 listing.longitude = longitude
+                listing.geo_cell = geo_cell(latitude, longitude)
                 listing.save()
+                if search_text_changed:
+                    update_search_vectors(Message.objects.filter(attached_listing=listing))
+                    update_listing_search_vectors(Listing.objects.filter(pk=listing.pk))
 
                 self.instance = listing
             except Listing.DoesNotExist:
                 self.instance = Listing.objects.create(
-                    title=title, price=price, category=category, description=description, latitude=latitude, longitude=longitude, user_id=user_id)
+                    title=title, price=price, category=category, description=description, latitude=latitude, longitude=longitude,
+                    geo_cell=geo_cell(latitude, longitude), user_id=user_id)
+                update_listing_search_vectors(Listing.objects.filter(pk=self.instance.pk))
 
             images = self.validated_data['images']
-            listToCreate = [ListingImage(
-                image=image, thumbnail_card=image, thumbnail_detail=image, listing_id=self.instance.id) for image in images]
+            # Uploaded images stay where they are, thumbnails are made in the background
+            listToCreate = [ListingImage(image=image, listing_id=self.instance.id)
+                            for image in images + self.validated_data['image_keys']]
             ListingImage.objects.bulk_create(listToCreate)
+            thumbnail_pipeline.submit_on_commit('api.ListingImage', [image.pk for image in listToCreate])
 
             return self.instance
 
 
+class PresignUploadSerializer(serializers.Serializer):
+    kind = serializers.ChoiceField(choices=list(UPLOAD_KINDS))
+    filename = serializers.CharField(max_length=255)
+    content_type = serializers.CharField(max_length=255)
+    size = serializers.IntegerField(min_value=1)
+
+    def validate(self, data):
+        spec = UPLOAD_KINDS[data['kind']]
+        if spec['content_types'] is not None and data['content_type'] not in spec['content_types']:
+            raise serializers.ValidationError({'content_type': f'Only {", ".join(spec["content_types"])} can be uploaded.'})
+        if data['size'] > spec['max_size']:
+            raise serializers.ValidationError({'size': f'Files cannot be larger than {spec["max_size"] // 1024 // 1024}MB!'})
+        return data
+
+    def save(self, **kwargs):
+        data = self.validated_data
+        return presign_upload(self.context['request'], data['kind'], data['filename'], data['content_type'])
+
+
+class DirectUploadSerializer(serializers.Serializer):
+    """The form of a presigned upload, as UploadView receives it in place of S3."""
+    key = serializers.CharField()
+    token = serializers.CharField()
+    file = serializers.FileField()
+
+    def validate(self, data):
+        upload = load_upload_token(data['token'])
+        if upload is None or upload['key'] != data['key']:
+            raise serializers.ValidationError('The upload is not allowed or has expired.')
+        if self.initial_data.get('Content-Type') != upload['content_type']:
+            raise serializers.ValidationError({'Content-Type': 'Does not match the presigned content type.'})
+        if data['file'].size > upload['max_size']:
+            raise serializers.ValidationError({'file': 'Larger than the presigned upload allows.'})
+        return data
+
+    def save(self, **kwargs):
+        # Stored under the presigned key or not at all, the client only knows that key
+        key = self.validated_data['key']
+        if default_storage.exists(key):
+            raise serializers.ValidationError({'key': 'Has already been uploaded.'})
+        name = default_storage.save(key, self.validated_data['file'])
+        if name != key:
+            default_storage.delete(name)
+            raise serializers.ValidationError({'key': 'Has already been uploaded.'})
+        return name
+
+
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
@@ -134,23 +236,41 @@ class CategorySerializer(serializers.ModelSerializer):
 class MessageFileSerializer(serializers.ModelSerializer):
     class Meta:
         model = MessageFile
-        fields = ['id', 'file']
+        fields = ['id', 'file', 'name']
 
 
 class MessageReplySerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = '__all__'
+        exclude = ['search_vector']
 
     from_user = UserSerializer()
     attached_listing = ListingSerializer()
     files = MessageFileSerializer(many=True)
 
 
+class MessageListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        messages = prefetch_forwarded_messages(iterable)
+
+        # Fragments are rendered by MessageSerializer whatever the child is, subclasses only add their own fields
+        request = self.context.get('request')
+        fragments = render_cache.render(
+            messages, lambda misses: FlatSerializer.for_serializer(MessageSerializer()).many(misses, request),
+            lambda ids: prefetch_forwarded_messages(load_messages(ids)),
+            prefix=request.build_absolute_uri('/') if request else '')
+        for message, fragment in zip(messages, fragments):
+            message._rendered_fragment = fragment
+
+        return super().to_representation(messages)
+
+
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = '__all__'
+        exclude = ['search_vector']
+        list_serializer_class = MessageListSerializer
 
     from_user = UserSerializer()
     to_user = UserSerializer()
@@ -159,10 +279,37 @@ class MessageSerializer(serializers.ModelSerializer):
     files = MessageFileSerializer(many=True)
 
     def to_representation(self, instance):
-        self.fields['attached_messages'] = SentOnMessageSerializer(many=True)
+        fragment = getattr(instance, '_rendered_fragment', None)
+        if fragment is not None:
+            return self.extend_fragment(instance, fragment)
 
         return super(MessageSerializer, self).to_representation(instance)
 
+    def get_fields(self):
+        # Declared here since SentOnMessageSerializer nests MessageSerializer back
+        fields = super().get_fields()
+        fields['attached_messages'] = SentOnMessageSerializer(many=True)
+        return fields
+
+    def extend_fragment(self, instance, fragment):
+        """Cached MessageSerializer fragment of `instance` with the fields a subclass adds on top."""
+        representation = dict(fragment)
+        for field in self._readable_fields:
+            if field.field_name not in representation:
+                attribute = field.get_attribute(instance)
+                representation[field.field_name] = None if attribute is None else field.to_representation(attribute)
+        return representation
+
+
+class MessageSearchSerializer(MessageSerializer):
+    class Meta:
+        model = Message
+        exclude = ['search_vector']
+        list_serializer_class = MessageListSerializer
+
+    rank = serializers.FloatField(read_only=True)
+    headline = serializers.CharField(read_only=True)
+
 
 class SentOnMessageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -175,41 +322,22 @@ class SentOnMessageSerializer(serializers.ModelSerializer):
 class CreateMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        exclude = ['from_user', 'is_deleted_for_from_user', 'is_deleted_for_to_user', 'is_edited', 'is_read']
+        exclude = ['from_user', 'is_deleted_for_from_user', 'is_deleted_for_to_user', 'is_edited', 'is_read', 'search_vector']
 
     attached_messages = serializers.ListField(
         child=serializers.IntegerField(), default=[], allow_empty=True, write_only=True)
     files = serializers.ListField(
         child=serializers.FileField(), default=[], allow_empty=True, write_only=True)
+    # Keys of files uploaded through a presigned upload
+    file_keys = serializers.ListField(
+        child=serializers.CharField(), default=[], allow_empty=True, write_only=True)
 
-    def save(self, **kwargs):
-        with transaction.atomic():
-            from_user = self.context['from_user']
-            to_user = self.validated_data['to_user']
-            text = self.validated_data['text']
-            files = self.validated_data['files']
-            attached_messages = self.validated_data['attached_messages']
-            del self.validated_data['files']
-            del self.validated_data['attached_messages']
-
-            self.instance = Message.objects.create(
-                **self.validated_data, from_user=from_user)
-
-            listToCreateFiles = [MessageFile(
-                message=self.instance, file=file) for file in files]
-
-            listToCreateSentOnMessages = [SentOnMessage(message_parent=self.instance, message=message)
-                                          for message in Message.objects.filter(Q(from_user=from_user) | Q(to_user=from_user)).filter(id__in=attached_messages)]
+    def validate_file_keys(self, value):
+        return validate_upload_keys('messageFile', value, self.context['from_user'].id)
 
-            MessageFile.objects.bulk_create(listToCreateFiles)
-            SentOnMessage.objects.bulk_create(listToCreateSentOnMessages)
-
-            try:
-                send_push_message(to_user.expoPushToken, from_user.name, text)
-            except:
-                pass
-
-            return self.instance
+    def save(self, **kwargs):
+        self.instance = create_messages([(self.context['from_user'], self.validated_data)])[0]
+        return self.instance
 
 
 class UpdateMessageSerializer(serializers.ModelSerializer):
@@ -218,7 +346,12 @@ class UpdateMessageSerializer(serializers.ModelSerializer):
         fields = ['text', 'used_for_reply_message', 'attached_listing']
 
     def save(self, **kwargs):
-        return super().save(**self.validated_data, is_edited=True)
+        with transaction.atomic():
+            instance = super().save(**self.validated_data, is_edited=True)
+            record_edit(instance)
+            render_cache.invalidate('message', [instance.pk])
+            update_search_vectors(Message.objects.filter(Q(pk=instance.pk) | Q(used_for_reply_message=instance)))
+            return instance
 
 
 class DeleteForMeMessageSerializer(serializers.ModelSerializer):
@@ -231,10 +364,14 @@ class DeleteForMeMessageSerializer(serializers.ModelSerializer):
     def save(self, **kwargs):
         from_user = self.context['from_user']
         messages = self.validated_data['messages']
-        Message.objects.filter(Q(from_user=from_user) & Q(pk__in=messages)).update(
-            is_deleted_for_from_user=True)
-        Message.objects.filter(Q(to_user=from_user) & Q(pk__in=messages)).update(
-            is_deleted_for_to_user=True)
+        with transaction.atomic():
+            discount_unread(Message.objects.filter(Q(to_user=from_user) & Q(pk__in=messages)))
+            Message.objects.filter(Q(from_user=from_user) & Q(pk__in=messages)).update(
+                is_deleted_for_from_user=True)
+            Message.objects.filter(Q(to_user=from_user) & Q(pk__in=messages)).update(
+                is_deleted_for_to_user=True)
+            record_deletion(messages, user_id=from_user.id)
+            render_cache.invalidate('message', messages)
 
 
 class DeleteForAllMessageSerializer(serializers.ModelSerializer):
@@ -247,8 +384,14 @@ class DeleteForAllMessageSerializer(serializers.ModelSerializer):
     def save(self, **kwargs):
         from_user = self.context['from_user']
         messages = self.validated_data['messages']
-        Message.objects.filter(Q(from_user=from_user) & Q(pk__in=messages)).update(
-            is_deleted_for_from_user=True, is_deleted_for_to_user=True)
+        with transaction.atomic():
+            messages = list(Message.objects.filter(Q(from_user=from_user) & Q(pk__in=messages)).values_list('pk', flat=True))
+            discount_unread(Message.objects.filter(pk__in=messages))
+            Message.objects.filter(pk__in=messages).update(
+                is_deleted_for_from_user=True, is_deleted_for_to_user=True)
+            clear_search_vectors(Message.objects.filter(pk__in=messages))
+            record_deletion(messages)
+            render_cache.invalidate('message', messages)
 
 
 class MarkAsReadMessageSerializer(serializers.ModelSerializer):
@@ -261,13 +404,19 @@ class MarkAsReadMessageSerializer(serializers.ModelSerializer):
     def save(self, **kwargs):
         from_user = self.context['from_user']
         messages = self.validated_data['messages']
-        Message.objects.filter(Q(to_user=from_user) & Q(pk__in=messages)).update(is_read=True)
+        with transaction.atomic():
+            discount_unread(Message.objects.filter(Q(to_user=from_user) & Q(pk__in=messages)))
+            Message.objects.filter(Q(to_user=from_user) & Q(pk__in=messages)).update(is_read=True)
+            render_cache.invalidate('message', messages)
 
 
 class ChatMessageSerializer(MessageSerializer):
     class Meta:
         model = Message
-        fields = '__all__'
+        exclude = ['search_vector']
+        list_serializer_class = MessageListSerializer
+
+    unread_count = serializers.IntegerField(read_only=True)
 
     from_user = UserSerializer()
     to_user = UserSerializer()
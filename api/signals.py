@@ -1,39 +1,107 @@
-from django.db.models.signals import post_delete, pre_save
+import functools
+import threading
+
+from django.db.models.fields.files import FieldFile
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
-from django.db import models
- 
-""" Whenever ANY model is deleted, if it has a file field on it, delete the associated file too."""
-@receiver(post_delete)
-def delete_files_when_row_deleted_from_db(sender, instance, **kwargs):
-    for field in sender._meta.concrete_fields:
-        if isinstance(field,models.FileField):
-            instance_file_field = getattr(instance,field.name)
-            delete_file_if_unused(sender,instance,field,instance_file_field)
-            
+from django.db import models, transaction
+
+from .utilities.fileDeletion import file_deletion_queue
+from .utilities.renderCache import render_cache
+from .utilities.userCache import user_cache
+
+""" Models whose files are deleted with their rows, or when another file replaces them"""
+FILE_TRACKED_MODELS = ['api.User', 'api.ListingImage', 'api.MessageFile']
+
+@functools.lru_cache(maxsize=None)
+def file_fields(model):
+    return [field for field in model._meta.concrete_fields if isinstance(field, models.FileField)]
+
+""" Remember the file names a row was loaded with, so a save can tell which files it replaced without reading the row again"""
+def record_file_names(sender, instance, **kwargs):
+    names = {}
+    for field in file_fields(sender):
+        # Deferred fields aren't loaded, a new row holds the file itself until it's saved
+        value = instance.__dict__.get(field.attname)
+        if isinstance(value, FieldFile):
+            value = value.name if value._committed else None
+        if isinstance(value, str):
+            names[field.attname] = value
+    instance._file_names = names
+
 """ Delete the file if something else get uploaded in its place"""
-@receiver(pre_save)
-def delete_files_when_file_changed(sender,instance, **kwargs):
-    # Don't run on initial save
-    if not instance.pk:
-        return
-    for field in sender._meta.concrete_fields:
-        if isinstance(field,models.FileField):
-            #its got a file field. Let's see if it changed
-            try:
-                instance_in_db = sender.objects.get(pk=instance.pk)
-            except sender.DoesNotExist:
-                # We are probably in a transaction and the PK is just temporary
-                # Don't worry about deleting attachments if they aren't actually saved yet.
-                return
-            instance_in_db_file_field = getattr(instance_in_db,field.name)
-            instance_file_field = getattr(instance,field.name)
-            if instance_in_db_file_field.name != instance_file_field.name:
-                delete_file_if_unused(sender,instance,field,instance_in_db_file_field)
-
-""" Only delete the file if no other instances of that model are using it"""    
-def delete_file_if_unused(model,instance,field,instance_file_field):
-    dynamic_field = {}
-    dynamic_field[field.name] = instance_file_field.name
-    other_refs_exist = model.objects.filter(**dynamic_field).exclude(pk=instance.pk).exists()
-    if not other_refs_exist:
-        instance_file_field.delete(False)
\ No newline at end of file
+def delete_files_when_file_changed(sender, instance, **kwargs):
+    original = getattr(instance, '_file_names', {})
+    for field in file_fields(sender):
+        if field.attname not in instance.__dict__:
+            continue
+        name = getattr(instance, field.attname).name
+        if original.get(field.attname) and original[field.attname] != name:
+            file_cleanup.add(sender, field, original[field.attname])
+    record_file_names(sender, instance)
+
+""" Whenever a tracked row is deleted, delete its files too"""
+def delete_files_when_row_deleted_from_db(sender, instance, **kwargs):
+    for field in file_fields(sender):
+        name = getattr(instance, field.attname).name
+        if name:
+            file_cleanup.add(sender, field, name)
+
+for label in FILE_TRACKED_MODELS:
+    post_init.connect(record_file_names, sender=label)
+    post_save.connect(delete_files_when_file_changed, sender=label)
+    post_delete.connect(delete_files_when_row_deleted_from_db, sender=label)
+
+
+class FileCleanup(threading.local):
+    """
+    Files that lost a reference in the current transaction, handed to the
+    file deletion queue in one insert once it commits. The queue deletes
+    them unless a row uses them again by then, as content-addressed fields
+    share one stored file between every row with the same content.
+    """
+
+    def __init__(self):
+        self.pending = set()
+
+    def add(self, model, field, name):
+        self.pending.add((model, field, name))
+        # The first flush to run takes every pending file. Files left by a rolled back
+        # savepoint are flushed later, and are still referenced by the rows it restored.
+        transaction.on_commit(self.flush)
+
+    def flush(self):
+        pending, self.pending = self.pending, set()
+        if pending:
+            file_deletion_queue.enqueue(pending)
+
+
+file_cleanup = FileCleanup()
+
+""" Drop cached users as soon as they change, instead of waiting for the cache TTL"""
+@receiver(post_save, sender='api.User')
+@receiver(post_delete, sender='api.User')
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance.pk)
+
+
+""" Drop rendered messages showing a user, listing or message file that changed"""
+@receiver(post_save, sender='api.User')
+@receiver(post_delete, sender='api.User')
+def invalidate_rendered_user(sender, instance, **kwargs):
+    render_cache.invalidate('user', [instance.pk])
+
+@receiver(post_save, sender='api.Listing')
+@receiver(post_delete, sender='api.Listing')
+def invalidate_rendered_listing(sender, instance, **kwargs):
+    render_cache.invalidate('listing', [instance.pk])
+
+@receiver(post_save, sender='api.ListingImage')
+@receiver(post_delete, sender='api.ListingImage')
+def invalidate_rendered_listing_image(sender, instance, **kwargs):
+    render_cache.invalidate('listing', [instance.listing_id])
+
+@receiver(post_save, sender='api.MessageFile')
+@receiver(post_delete, sender='api.MessageFile')
+def invalidate_rendered_message_file(sender, instance, **kwargs):
+    render_cache.invalidate('message', [instance.message_id])
@@ -1,6 +1,23 @@
 import os
+from boto3.s3.transfer import TransferConfig
 from storages.backends.s3boto3 import S3Boto3Storage
-from tempfile import SpooledTemporaryFile
+
+
+class UnclosableFile:
+    """
+    Proxy of a file that ignores `close`, so boto3 can't close the file
+    storage still holds. Every other attribute is the file's own.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        pass
+
 
 class CustomS3Boto3Storage(S3Boto3Storage):
     """
@@ -10,25 +27,38 @@ class CustomS3Boto3Storage(S3Boto3Storage):
     https://github.com/matthewwithanm/django-imagekit/issues/391#issuecomment-275367006
     https://github.com/boto/boto3/issues/929
     https://github.com/matthewwithanm/django-imagekit/issues/391
+
+    Uploads are streamed instead of copied: files Django spooled to disk are
+    sent from their path, part by part, and other files are read through a
+    proxy that boto3 can't close. Multipart uploads keep at most
+    `max_in_memory_upload_chunks` parts of `multipart_chunksize` in memory.
     """
+    transfer_config = TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=8 * 1024 * 1024,
+        max_concurrency=4,
+    )
+    # Not a boto3 TransferConfig argument, but read by s3transfer
+    transfer_config.max_in_memory_upload_chunks = 4
 
     def _save(self, name, content):
-        """
-        We create a clone of the content file as when this is passed to
-        boto3 it wrongly closes the file upon upload where as the storage
-        backend expects it to still be open
-        """
-        # Seek our content back to the start
-        content.seek(0, os.SEEK_SET)
-
-        # Create a temporary file that will write to disk after a specified
-        # size. This file will be automatically deleted when closed by
-        # boto3 or after exiting the `with` statement if the boto3 is fixed
-        with SpooledTemporaryFile() as content_autoclose:
+        cleaned_name = self._clean_name(name)
+        name = self._normalize_name(cleaned_name)
+        params = self._get_write_parameters(name, content)
 
-            # Write our original content into our copy that will be closed by boto3
-            content_autoclose.write(content.read())
+        # Seek our content back to the start
+        if not hasattr(content, 'seekable') or content.seekable():
+            content.seek(0, os.SEEK_SET)
+        if (self.gzip and
+                params['ContentType'] in self.gzip_content_types and
+                'ContentEncoding' not in params):
+            content = self._compress_content(content)
+            params['ContentEncoding'] = 'gzip'
 
-            # Upload the object which will auto close the
-            # content_autoclose instance
-            return super(CustomS3Boto3Storage, self)._save(name, content_autoclose)
\ No newline at end of file
+        obj = self.bucket.Object(name)
+        if hasattr(content, 'temporary_file_path'):
+            # TemporaryUploadedFile, boto3 reads each part straight from disk
+            obj.upload_file(content.temporary_file_path(), ExtraArgs=params, Config=self.transfer_config)
+        else:
+            obj.upload_fileobj(UnclosableFile(content), ExtraArgs=params, Config=self.transfer_config)
+        return cleaned_name
@@ -1,3 +1,162 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from exponent_server_sdk import PushMessage
+
+from api.models import User
+from api.utilities import presence
+from api.utilities.presence import MemoryPresence, get_presence
+from api.utilities.pushNotifications import Notification, PushQueue, push_counters
+
+
+class ExpoStub(ThreadingHTTPServer):
+    """
+    Local stand-in for the Expo push API. The first send request fails with
+    a 503 when `fail_first` is set, tokens containing 'throttled' are rate limited once, and receipts
+    of tokens containing 'dead' report DeviceNotRegistered.
+    """
+
+    def __init__(self, fail_first=True):
+        super().__init__(('127.0.0.1', 0), ExpoStubHandler)
+        self.fail_first = fail_first
+        self.send_requests = []
+        self.receipt_requests = []
+        self.tokens = {}
+        self.throttled = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class ExpoStubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        server = self.server
+        with server.lock:
+            if self.path.endswith('/push/send'):
+                server.send_requests.append(body)
+                if server.fail_first and len(server.send_requests) == 1:
+                    return self.reply(503, {'errors': [{'code': 'INTERNAL_SERVER_ERROR', 'message': 'Try again'}]})
+                return self.reply(200, {'data': [self.ticket(message['to']) for message in body]})
+
+            server.receipt_requests.append(body)
+            return self.reply(200, {'data': {id: self.receipt(server.tokens[id]) for id in body['ids']}})
+
+    def ticket(self, token):
+        server = self.server
+        if 'throttled' in token and token not in server.throttled:
+            server.throttled.add(token)
+            return {'status': 'error', 'message': 'Too many messages', 'details': {'error': 'MessageRateExceeded'}}
+
+        id = f'ticket-{len(server.tokens)}'
+        server.tokens[id] = token
+        return {'status': 'ok', 'id': id}
+
+    def receipt(self, token):
+        if 'dead' in token:
+            return {'status': 'error', 'message': 'Not registered', 'details': {'error': 'DeviceNotRegistered'}}
+        return {'status': 'ok'}
+
+    def reply(self, status, data):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+# The push worker reads users on its own thread and connection, so rows are committed rather than rolled back
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'push-queue-tests'}},
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PushQueueTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(presence, 'memory_presence', MemoryPresence())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_stub(self, **kwargs):
+        stub = ExpoStub(**kwargs)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        self.addCleanup(stub.server_close)
+        self.addCleanup(stub.shutdown)
+        return stub
+
+    def start_queue(self, stub):
+        push_queue = PushQueue(host=stub.url)
+        self.addCleanup(push_queue.stop)
+        return push_queue
+
+    def wait_for(self, condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out waiting for the push queue')
+            time.sleep(0.05)
+
+    def test_delivery(self):
+        count = 250
+        stub = self.start_stub()
+        push_queue = self.start_queue(stub)
+        push_queue.backoff = 0.1
+        push_queue.receipt_delay = 0.5
+
+        tokens = [f'ExponentPushToken[{"dead" if index % 50 == 0 else "throttled" if index % 70 == 1 else "ok"}-{index}]'
+                  for index in range(count)]
+        users = User.objects.bulk_create([User(email=f'push-{index}@example.com', name='Dead token', expoPushToken=token)
+                                          for index, token in enumerate(tokens) if 'dead' in token])
+
+        for token in tokens + ['not a token']:
+            push_queue.enqueue(PushMessage(to=token, title='Sender', body='Hello', sound='default'))
+        self.wait_for(lambda: sum(len(request['ids']) for request in stub.receipt_requests) >= count
+                      and push_counters()['pruned'] >= len(users))
+
+        self.assertLessEqual(max(len(request) for request in stub.send_requests), PushQueue.batch_size)
+        self.assertEqual(len(stub.throttled), len([token for token in tokens if 'throttled' in token]))
+        self.assertEqual(sum(len(request['ids']) for request in stub.receipt_requests), count)
+        self.assertFalse(User.objects.filter(id__in=[user.id for user in users], expoPushToken__isnull=False).exists())
+        # Dead tokens are accepted, then reported by their receipts, the malformed token never leaves
+        self.assertEqual(push_counters(), {'sent': count, 'failed': 1, 'skipped': 0, 'undelivered': len(users),
+                                           'pruned': len(users)})
+
+    def test_coalescing(self):
+        stub = self.start_stub(fail_first=False)
+        push_queue = self.start_queue(stub)
+        push_queue.coalesce_window = 0.3
+        push_queue.rate_limit = 3
+        push_queue.rate_period = 1.5
+
+        # User 1 gets a burst from one sender, user 2 messages from 5 senders, user 3 has the chat open
+        online_user_id = 3
+        asyncio.run(get_presence().connect(online_user_id, 'push-queue-tests'))
+        notifications = [Notification(1, 10, 'ExponentPushToken[burst]', 'Sender', f'Message {index}') for index in range(20)]
+        notifications += [Notification(2, sender_id, 'ExponentPushToken[busy]', f'Sender {sender_id}', 'Hello')
+                          for sender_id in range(20, 25)]
+        notifications += [Notification(online_user_id, 10, 'ExponentPushToken[online]', 'Sender', 'Hello')]
+        for notification in notifications:
+            push_queue.enqueue(notification)
+        self.wait_for(lambda: sum(len(request) for request in stub.send_requests) >= 6)
+
+        bodies = {}
+        for request in stub.send_requests:
+            for message in request:
+                bodies.setdefault(message['to'], []).append(message['body'])
+        self.assertEqual(bodies.get('ExponentPushToken[burst]'), ['20 new messages'])
+        self.assertEqual(len(bodies.get('ExponentPushToken[busy]')), 5)
+        self.assertNotIn('ExponentPushToken[online]', bodies)
+        # Over the cap of 3 pushes per period, the last 2 senders wait for the next one
+        self.assertGreaterEqual(len(stub.send_requests), 2)
+        self.assertEqual(push_counters()['skipped'], 1)
@@ -12,5 +12,9 @@ listings_router.register('images', views.ListingImageViewSet, basename='listing-
 
 urlpatterns = [
     path('expoPushToken/', views.ExpoPushTokenView.as_view()),
+    path('presence/', views.PresenceView.as_view()),
+    path('pushStats/', views.PushStatsView.as_view()),
+    path('uploads/presign/', views.PresignUploadView.as_view()),
+    path('uploads/', views.UploadView.as_view(), name='uploads'),
     path('webSocketTester/', views.webSocketTester)
 ] + router.urls + listings_router.urls
@@ -0,0 +1,176 @@
+from collections import Counter
+
+from django.db import connection
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from api.models import Conversation, ConversationMember, Message
+
+
+def visible_messages_q(user_id):
+    return ((Q(from_user__id=user_id) & Q(is_deleted_for_from_user=False)) | (
+        Q(to_user__id=user_id) & Q(is_deleted_for_to_user=False)))
+
+
+def ordered_pair(first_user_id, second_user_id):
+    return min(first_user_id, second_user_id), max(first_user_id, second_user_id)
+
+
+def pair_messages(first_user_id, second_user_id):
+    return Message.objects.filter(
+        Q(from_user_id=first_user_id, to_user_id=second_user_id) |
+        Q(from_user_id=second_user_id, to_user_id=first_user_id))
+
+
+def get_or_create_conversation(first_user_id, second_user_id):
+    first_user_id, second_user_id = ordered_pair(first_user_id, second_user_id)
+    conversation, created = Conversation.objects.get_or_create(
+        first_user_id=first_user_id, second_user_id=second_user_id)
+    if created:
+        ConversationMember.objects.bulk_create([ConversationMember(
+            conversation=conversation, user_id=user_id) for user_id in {first_user_id, second_user_id}])
+    return conversation
+
+
+def pair_conversations(pairs):
+    if not pairs:
+        return {}
+    by_pair = Q()
+    for first_user_id, second_user_id in pairs:
+        by_pair |= Q(first_user_id=first_user_id, second_user_id=second_user_id)
+    return {(conversation.first_user_id, conversation.second_user_id): conversation
+            for conversation in Conversation.objects.filter(by_pair)}
+
+
+def get_or_create_conversations(pairs):
+    """Conversations of ordered user id pairs by pair, created along with their members where missing."""
+    pairs = set(pairs)
+    conversations = pair_conversations(pairs)
+
+    missing = pairs - conversations.keys()
+    if missing:
+        # Conflicting rows were created by concurrent sends, they are loaded below like the new ones
+        Conversation.objects.bulk_create([Conversation(first_user_id=first_user_id, second_user_id=second_user_id)
+                                          for first_user_id, second_user_id in missing], ignore_conflicts=True)
+        conversations.update(pair_conversations(missing))
+        ConversationMember.objects.bulk_create([
+            ConversationMember(conversation=conversations[pair], user_id=user_id)
+            for pair in missing for user_id in set(pair)], ignore_conflicts=True)
+    return conversations
+
+
+def record_messages(messages):
+    """
+    Point the conversations of freshly created messages, and both of their
+    sides, at the newest of them, with one UPDATE per table for the whole batch.
+    """
+    newest = {}
+    unread = Counter()
+    for message in messages:
+        pair = ordered_pair(message.from_user_id, message.to_user_id)
+        if pair not in newest or (message.sent_at, message.id) > (newest[pair].sent_at, newest[pair].id):
+            newest[pair] = message
+        if message.from_user_id != message.to_user_id:
+            unread[(pair, message.to_user_id)] += 1
+    if not newest:
+        return {}
+
+    conversations = get_or_create_conversations(newest)
+    latest = [value for pair, message in newest.items() for value in (conversations[pair].id, message.id, message.sent_at)]
+    latest_values = ', '.join(['(%s, %s, %s)'] * len(newest))
+    conversation_table, member_table = Conversation._meta.db_table, ConversationMember._meta.db_table
+
+    with connection.cursor() as cursor:
+        # Conditional updates keep the newest message when concurrent sends commit out of order
+        cursor.execute(f"""
+            UPDATE {conversation_table} c
+            SET last_message_id = v.message_id, last_message_at = v.sent_at, last_activity_at = v.sent_at
+            FROM (VALUES {latest_values}) v (conversation_id, message_id, sent_at)
+            WHERE c.id = v.conversation_id AND (c.last_message_at IS NULL OR c.last_message_at <= v.sent_at)
+        """, latest)
+        cursor.execute(f"""
+            UPDATE {member_table} m
+            SET last_message_id = v.message_id, last_message_at = v.sent_at
+            FROM (VALUES {latest_values}) v (conversation_id, message_id, sent_at)
+            WHERE m.conversation_id = v.conversation_id AND (m.last_message_at IS NULL OR m.last_message_at <= v.sent_at)
+        """, latest)
+        if unread:
+            cursor.execute(f"""
+                UPDATE {member_table} m
+                SET unread_count = m.unread_count + v.count
+                FROM (VALUES {', '.join(['(%s, %s, %s)'] * len(unread))}) v (conversation_id, user_id, count)
+                WHERE m.conversation_id = v.conversation_id AND m.user_id = v.user_id
+            """, [value for (pair, user_id), count in unread.items() for value in (conversations[pair].id, user_id, count)])
+
+    return conversations
+
+
+def record_edit(message):
+    first_user_id, second_user_id = ordered_pair(message.from_user_id, message.to_user_id)
+    Conversation.objects.filter(first_user_id=first_user_id, second_user_id=second_user_id).update(
+        last_activity_at=timezone.now())
+
+
+def refresh_members(members):
+    """Recompute the last visible message of each side, e.g. after some of its messages were deleted."""
+    for member in members.select_related('conversation'):
+        conversation = member.conversation
+        last_message = pair_messages(conversation.first_user_id, conversation.second_user_id) \
+            .filter(visible_messages_q(member.user_id)).order_by('-sent_at', '-id').first()
+
+        member.last_message = last_message
+        member.last_message_at = last_message.sent_at if last_message else None
+        member.save(update_fields=['last_message', 'last_message_at'])
+
+
+def refresh_conversations(conversations):
+    for conversation in conversations:
+        conversation.last_message = pair_messages(conversation.first_user_id, conversation.second_user_id) \
+            .filter(Q(is_deleted_for_from_user=False) | Q(is_deleted_for_to_user=False)) \
+            .order_by('-sent_at', '-id').first()
+        conversation.last_message_at = conversation.last_message.sent_at if conversation.last_message else None
+        conversation.save(update_fields=['last_message', 'last_message_at'])
+
+
+def record_deletion(message_ids, user_id=None):
+    """
+    Move the pointers that referenced any of the just hidden messages back to
+    the previous visible one. Pass `user_id` when the messages were hidden for
+    that user only.
+    """
+    members = ConversationMember.objects.filter(last_message_id__in=message_ids)
+    conversations = Conversation.objects.filter(last_message_id__in=message_ids)
+    if user_id is not None:
+        members = members.filter(user_id=user_id)
+        conversations = conversations.filter(Q(first_user_id=user_id) | Q(second_user_id=user_id))
+    refresh_members(members)
+    refresh_conversations(conversations)
+
+
+def unread_messages(messages):
+    """Messages that are counted in their recipient's unread counter."""
+    return messages.filter(is_read=False, is_deleted_for_to_user=False).exclude(from_user=F('to_user'))
+
+
+def discount_unread(messages):
+    """
+    Take `messages` out of their recipients' unread counters. Call it inside
+    the transaction, right before the messages get read or hidden for their
+    recipient; the rows stay locked so concurrent requests can't discount them twice.
+    """
+    counts = Counter(unread_messages(messages).select_for_update().values_list('to_user_id', 'from_user_id'))
+
+    for (to_user_id, from_user_id), count in counts.items():
+        first_user_id, second_user_id = ordered_pair(to_user_id, from_user_id)
+        ConversationMember.objects.filter(
+            user_id=to_user_id, conversation__first_user_id=first_user_id, conversation__second_user_id=second_user_id) \
+            .update(unread_count=Greatest(F('unread_count') - count, 0))
+
+
+def recount_unread(members):
+    for member in members.select_related('conversation'):
+        conversation = member.conversation
+        member.unread_count = unread_messages(
+            pair_messages(conversation.first_user_id, conversation.second_user_id)).filter(to_user_id=member.user_id).count()
+        member.save(update_fields=['unread_count'])
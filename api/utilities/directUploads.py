@@ -0,0 +1,131 @@
+import io
+import os
+import uuid
+
+from django.apps import apps
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils.text import get_valid_filename
+from PIL import Image
+from rest_framework import serializers
+
+# What clients may upload straight to storage, and where it lands
+UPLOAD_KINDS = {
+    'listingImage': {
+        'directory': 'api/uploads/images',
+        'field': 'api.ListingImage.image',
+        'content_types': ['image/jpeg', 'image/png', 'image/webp', 'image/gif'],
+        'image_formats': ['JPEG', 'PNG', 'WEBP', 'GIF'],
+        'max_size': 100 * 1024 * 1024,
+    },
+    'messageFile': {
+        'directory': 'api/uploads/messageFiles',
+        'field': 'api.MessageFile.file',
+        'content_types': None,
+        'image_formats': None,
+        'max_size': 100 * 1024 * 1024,
+    },
+}
+
+PRESIGN_EXPIRES = 60 * 60
+# Enough of a file to read the header of any image format we accept
+HEAD_SIZE = 64 * 1024
+
+
+def upload_prefix(kind, user_id):
+    return f'{UPLOAD_KINDS[kind]["directory"]}/{user_id}/'
+
+
+def key_max_length(kind):
+    """Longest key the field storing uploads of `kind` holds."""
+    model_label, field_name = UPLOAD_KINDS[kind]['field'].rsplit('.', 1)
+    return apps.get_model(model_label)._meta.get_field(field_name).max_length
+
+
+def presign_upload(request, kind, filename, content_type):
+    """
+    Returns where the client posts a file of `kind` to: the storage key it
+    will have, the URL, and the form fields to send along with the file.
+    Uploads go to S3 directly when it is the storage, and to UploadView,
+    a stand-in with the same form fields, otherwise.
+    """
+    spec = UPLOAD_KINDS[kind]
+    directory = f'{upload_prefix(kind, request.user.id)}{uuid.uuid4().hex}/'
+    stem, extension = os.path.splitext(get_valid_filename(os.path.basename(filename)) or 'file')
+    # Shortened to fit the field, keeping the extension
+    extension = extension[:16]
+    key = directory + stem[:key_max_length(kind) - len(directory) - len(extension)] + extension
+
+    if hasattr(default_storage, 'bucket'):
+        return presign_s3_upload(default_storage, key, content_type, spec['max_size'])
+
+    token = signing.dumps({'key': key, 'content_type': content_type, 'max_size': spec['max_size']}, salt='upload')
+    return {
+        'key': key,
+        'url': request.build_absolute_uri(reverse('uploads')),
+        'fields': {'key': key, 'Content-Type': content_type, 'token': token},
+    }
+
+
+def presign_s3_upload(storage, key, content_type, max_size):
+    fields = {'Content-Type': content_type}
+    conditions = [{'Content-Type': content_type}, ['content-length-range', 1, max_size]]
+    if storage.default_acl:
+        fields['acl'] = storage.default_acl
+        conditions.append({'acl': storage.default_acl})
+
+    post = storage.bucket.meta.client.generate_presigned_post(
+        Bucket=storage.bucket_name,
+        Key=storage._normalize_name(storage._clean_name(key)),
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=PRESIGN_EXPIRES)
+    return {'key': key, 'url': post['url'], 'fields': post['fields']}
+
+
+def load_upload_token(token):
+    """The upload a signed UploadView token allows, or None when it is forged or expired."""
+    try:
+        return signing.loads(token, salt='upload', max_age=PRESIGN_EXPIRES)
+    except signing.BadSignature:
+        return None
+
+
+def read_head(storage, key):
+    if hasattr(storage, 'bucket'):
+        # A ranged GET, opening the file would download all of it
+        obj = storage.bucket.Object(storage._normalize_name(storage._clean_name(key)))
+        return obj.get(Range=f'bytes=0-{HEAD_SIZE - 1}')['Body'].read()
+
+    with storage.open(key) as file:
+        return file.read(HEAD_SIZE)
+
+
+def validate_upload_keys(kind, keys, user_id):
+    """
+    Checks keys of finished direct uploads before rows point at them: each
+    must be the user's own upload of `kind`, exist, fit the size limit
+    and, for images, really be an image.
+    """
+    spec = UPLOAD_KINDS[kind]
+    prefix = upload_prefix(kind, user_id)
+    for key in keys:
+        if not key.startswith(prefix) or '..' in key.split('/'):
+            raise serializers.ValidationError(f'{key} is not an upload of yours.')
+        if len(key) > key_max_length(kind):
+            raise serializers.ValidationError(f'{key} is too long.')
+        if not default_storage.exists(key):
+            raise serializers.ValidationError(f'{key} has not been uploaded.')
+        if default_storage.size(key) > spec['max_size']:
+            raise serializers.ValidationError(f'Files cannot be larger than {spec["max_size"] // 1024 // 1024}MB!')
+
+        if spec['image_formats'] is not None:
+            try:
+                image_format = Image.open(io.BytesIO(read_head(default_storage, key))).format
+            except Exception:
+                image_format = None
+            if image_format not in spec['image_formats']:
+                raise serializers.ValidationError(f'{key} is not a supported image.')
+
+    return keys
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import weakref
+from collections import defaultdict, deque
+
+import redis.asyncio
+from django.conf import settings
+
+from .presence import redis_url
+
+
+class MemoryEventLog:
+    """
+    Event log for the in-memory channel layer: the last `max_length` events
+    of every user in a ring buffer, numbered by a per-user sequence.
+    """
+    max_length = 1000
+
+    def __init__(self):
+        self.events = defaultdict(lambda: deque(maxlen=self.max_length))
+        self.sequences = defaultdict(int)
+
+    async def append(self, user_id, event):
+        self.sequences[user_id] += 1
+        self.events[user_id].append((self.sequences[user_id], event))
+        return self.sequences[user_id]
+
+    async def since(self, user_id, last_seq):
+        """
+        Events of `user_id` after `last_seq` as (seq, event) pairs, or None
+        when some of them already fell out of the log.
+        """
+        current = self.sequences.get(user_id, 0)
+        events = [(seq, event) for seq, event in self.events.get(user_id, ()) if seq > last_seq]
+        first_missed = events[0][0] if events else current + 1
+        # Also covers a client ahead of a log that was reset
+        if first_missed > last_seq + 1 and current > last_seq or last_seq > current:
+            return None
+        return events
+
+
+class RedisEventLog:
+    """
+    Event log stored in a Redis stream per user, next to the channel layer.
+    Stream ids are `<seq>-0`, with `seq` taken from a per-user counter in
+    the same script, so they stay gapless and ordered across workers. Both
+    keys expire `ttl` seconds after the user's last event; a counter lost
+    with them makes since() ask for a resync.
+    """
+    max_length = 1000
+    ttl = 60 * 60 * 24
+
+    append_script = """
+        local seq = redis.call('INCR', KEYS[2])
+        redis.call('XADD', KEYS[1], 'MAXLEN', ARGV[2], seq .. '-0', 'event', ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        return seq
+    """
+
+    def __init__(self, url):
+        self.redis = redis.asyncio.from_url(url)
+        self.append_events = self.redis.register_script(self.append_script)
+
+    def keys(self, user_id):
+        return [f'events:{user_id}', f'events-seq:{user_id}']
+
+    async def append(self, user_id, event):
+        return await self.append_events(keys=self.keys(user_id),
+                                        args=[json.dumps(event), self.max_length, self.ttl])
+
+    async def since(self, user_id, last_seq):
+        stream_key, seq_key = self.keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(seq_key)
+            pipe.xrange(stream_key, min=f'{last_seq + 1}-0', count=self.max_length)
+            current, entries = await pipe.execute()
+
+        current = int(current or 0)
+        events = [(int(entry_id.split(b'-')[0]), json.loads(fields[b'event'])) for entry_id, fields in entries]
+        first_missed = events[0][0] if events else current + 1
+        # Also covers a client ahead of a log that was reset
+        if first_missed > last_seq + 1 and current > last_seq or last_seq > current:
+            return None
+        return events
+
+
+event_logs = weakref.WeakKeyDictionary()
+memory_event_log = MemoryEventLog()
+
+
+def get_event_log():
+    """Event log backend matching the default channel layer. Redis clients are bound to the running loop."""
+    layer = settings.CHANNEL_LAYERS['default']
+    if 'Redis' not in layer['BACKEND']:
+        return memory_event_log
+
+    loop = asyncio.get_running_loop()
+    if loop not in event_logs:
+        event_logs[loop] = RedisEventLog(redis_url(layer['CONFIG']['hosts'][0]))
+    return event_logs[loop]
+
+
+async def send_to_user(channel_layer, user_id, event):
+    """Logs an event for `user_id` and delivers it to their sockets, numbered with its sequence."""
+    seq = await get_event_log().append(user_id, event)
+    await channel_layer.group_send(f'user-{user_id}', dict(event, seq=seq))
@@ -0,0 +1,147 @@
+import datetime
+import logging
+import threading
+from collections import defaultdict
+
+from django.apps import apps
+from django.db import close_old_connections, transaction
+from django.db.models import F, IntegerField, Value
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def referenced(model, files):
+    """Indexes of the (field name, file name) pairs some row still uses, each checked with a LIMIT 1 branch of one UNION ALL."""
+    queries = [model.objects.filter(**{field: name}).annotate(file_index=Value(index, IntegerField()))
+               .values_list('file_index', flat=True)[:1] for index, (field, name) in enumerate(files)]
+    return set(queries[0].union(*queries[1:], all=True)) if queries else set()
+
+
+def storage_key(storage, name):
+    return storage._normalize_name(storage._clean_name(name))
+
+
+def delete_many(storage, names):
+    """Deletes stored files, with one DeleteObjects request on S3. Returns the names that could not be deleted."""
+    if not hasattr(storage, 'bucket'):
+        failed = []
+        for name in names:
+            try:
+                storage.delete(name)
+            except OSError:
+                failed.append(name)
+        return failed
+
+    keys = {storage_key(storage, name): name for name in names}
+    response = storage.bucket.meta.client.delete_objects(
+        Bucket=storage.bucket_name,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    return [keys[error['Key']] for error in response.get('Errors', [])]
+
+
+class FileDeletionQueue:
+    """
+    Stored files deleted in the background, after the transactions that
+    orphaned them commit. The queue is kept in PendingFileDeletion, so
+    files left by a restart are deleted by the next worker. A worker
+    thread takes up to `batch_size` rows at a time, keeps the files a row
+    uses again, and deletes the rest with one bulk call per storage.
+
+    Content-addressed saves reuse a stored object without uploading it, so
+    a row saved while its object is being deleted could point at nothing.
+    Rows wait out a grace period first, longer than any transaction saving
+    a file, and saves reusing an object go through `keep`.
+    """
+    batch_size = 1000
+    poll_interval = 60
+    grace_period = datetime.timedelta(minutes=10)
+    max_attempts = 5
+
+    def __init__(self):
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def rows(self):
+        # Looked up when used, api.signals loads this module before the models exist
+        return apps.get_model('api', 'PendingFileDeletion').objects
+
+    def enqueue(self, files):
+        """Queues (model, field, name) triples, the rows are inserted at once."""
+        self.rows.bulk_create([
+            self.rows.model(model=model._meta.label, field=field.name, name=name)
+            for model, field, name in files], ignore_conflicts=True)
+
+        self.wake.set()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='file-deletion-queue', daemon=True)
+                self.thread.start()
+
+    def keep(self, name):
+        """
+        Drops the queued deletions of a stored object about to be used
+        again. Waits for a batch deleting it to commit, callers check the
+        object still exists afterwards.
+        """
+        self.rows.filter(name=name).delete()
+
+    def failed(self):
+        """Rows given up on after `max_attempts`, reported by reconcile_files."""
+        return self.rows.filter(attempts__gte=self.max_attempts)
+
+    def run(self):
+        while True:
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('File deletion round failed')
+            finally:
+                close_old_connections()
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+
+    def drain(self):
+        """Processes batches until the queue is empty or a batch leaves files to retry later."""
+        close_old_connections()
+        while True:
+            processed, failed = self.process_batch()
+            if processed < self.batch_size or failed:
+                return
+
+    def process_batch(self):
+        with transaction.atomic():
+            # Skipped when locked, so workers of every process can drain the queue together
+            rows = list(self.rows.select_for_update(skip_locked=True)
+                        .filter(attempts__lt=self.max_attempts, created_at__lte=timezone.now() - self.grace_period)
+                        .order_by('id')[:self.batch_size])
+            if not rows:
+                return 0, 0
+
+            by_model = defaultdict(list)
+            for row in rows:
+                by_model[row.model].append(row)
+
+            by_storage = defaultdict(list)
+            for label, model_rows in by_model.items():
+                model = apps.get_model(label)
+                used = referenced(model, [(row.field, row.name) for row in model_rows])
+                for index, row in enumerate(model_rows):
+                    if index not in used:
+                        by_storage[model._meta.get_field(row.field).storage].append(row)
+
+            failed = set()
+            for storage, storage_rows in by_storage.items():
+                failed |= set(delete_many(storage, [row.name for row in storage_rows]))
+
+            self.rows.filter(id__in=[row.id for row in rows if row.name not in failed]).delete()
+            if failed:
+                self.rows.filter(id__in=[row.id for row in rows if row.name in failed]) \
+                    .update(attempts=F('attempts') + 1)
+                logger.warning('%d files could not be deleted, retrying later', len(failed))
+            return len(rows), len(failed)
+
+
+file_deletion_queue = FileDeletionQueue()
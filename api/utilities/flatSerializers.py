@@ -0,0 +1,113 @@
+from django.db import models
+from django.utils.encoding import filepath_to_uri
+from rest_framework import serializers
+
+
+class MediaUrls:
+    """
+    URLs of stored files for one response. The storage URL prefix is
+    built once per storage, then file names are appended to it, the same
+    way FileSystemStorage and public S3 buckets build them.
+    """
+
+    def __init__(self, request=None):
+        self.request = request
+        self.prefixes = {}
+
+    def prefix(self, storage):
+        prefix = self.prefixes.get(id(storage))
+        if prefix is None:
+            prefix = storage.url('x')[:-1]
+            if self.request is not None:
+                prefix = self.request.build_absolute_uri(prefix)
+            self.prefixes[id(storage)] = prefix
+        return prefix
+
+    def url(self, file):
+        if not file:
+            return None
+        return self.prefix(file.storage) + filepath_to_uri(file.name)
+
+
+class FlatSerializer:
+    """
+    Read-only version of a DRF serializer, compiled once from its fields
+    into a list of accessors that build plain dicts. The output is the
+    same as the serializer's `to_representation` for the fields kinds
+    used by our read serializers; other fields fall back to their own
+    `to_representation`.
+    """
+    compiled = {}
+
+    @classmethod
+    def for_serializer(cls, serializer):
+        serializer_class = type(serializer)
+        if serializer_class not in cls.compiled:
+            flat_serializer = cls.compiled[serializer_class] = cls()
+            # Registered before compiling so recursive serializers reuse it
+            flat_serializer.compile(serializer)
+        return cls.compiled[serializer_class]
+
+    def __init__(self):
+        self.accessors = []
+
+    def compile(self, serializer):
+        model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+        self.accessors = [(field.field_name, self.compile_field(field, model))
+                          for field in serializer._readable_fields]
+
+    def compile_field(self, field, model):
+        get = self.compile_source(field)
+
+        if isinstance(field, serializers.ListSerializer):
+            child = FlatSerializer.for_serializer(field.child)
+
+            def many(instance, urls):
+                value = get(instance)
+                iterable = value.all() if isinstance(value, models.Manager) else value
+                return [child.to_representation(item, urls) for item in iterable]
+            return many
+
+        if isinstance(field, serializers.BaseSerializer):
+            child = FlatSerializer.for_serializer(field)
+
+            def nested(instance, urls):
+                value = get(instance)
+                return None if value is None else child.to_representation(value, urls)
+            return nested
+
+        if isinstance(field, serializers.FileField):
+            return lambda instance, urls: urls.url(get(instance))
+
+        if isinstance(field, serializers.SerializerMethodField):
+            method = getattr(field.parent, field.method_name)
+            return lambda instance, urls: method(instance)
+
+        if isinstance(field, serializers.PrimaryKeyRelatedField) and model is not None and len(field.source_attrs) == 1:
+            attname = model._meta.get_field(field.source).attname
+            return lambda instance, urls: getattr(instance, attname)
+
+        # Model values these fields already return as they are
+        if type(field) in (serializers.IntegerField, serializers.CharField, serializers.EmailField,
+                           serializers.BooleanField, serializers.ReadOnlyField):
+            return lambda instance, urls: get(instance)
+
+        def generic(instance, urls):
+            value = get(instance)
+            return None if value is None else field.to_representation(value)
+        return generic
+
+    def compile_source(self, field):
+        if field.source == '*':
+            return lambda instance: instance
+        if len(field.source_attrs) == 1:
+            attribute = field.source_attrs[0]
+            return lambda instance: getattr(instance, attribute)
+        return field.get_attribute
+
+    def to_representation(self, instance, urls):
+        return {name: accessor(instance, urls) for name, accessor in self.accessors}
+
+    def many(self, instances, request=None):
+        urls = MediaUrls(request)
+        return [self.to_representation(instance, urls) for instance in instances]
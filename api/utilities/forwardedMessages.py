@@ -0,0 +1,81 @@
+from api.models import Message, SentOnMessage
+
+
+# Relations every serialized message needs. Forwarded messages are loaded with
+# the same lookups, so each relation costs one query per page no matter how
+# deep the forward chain goes.
+MESSAGE_SELECT_RELATED = ['from_user', 'to_user', 'attached_listing__user',
+                          'used_for_reply_message__from_user', 'used_for_reply_message__attached_listing__user']
+MESSAGE_PREFETCH_RELATED = ['files', 'attached_listing__images',
+                            'used_for_reply_message__files', 'used_for_reply_message__attached_listing__images']
+
+
+def load_messages(ids):
+    """Messages with every relation they are serialized with, forwarded ones excepted."""
+    return Message.objects.filter(id__in=ids) \
+        .select_related(*MESSAGE_SELECT_RELATED) \
+        .prefetch_related(*MESSAGE_PREFETCH_RELATED)
+
+
+def forward_graph_query(message_ids):
+    """Build the recursive query returning every SentOnMessage row reachable from `message_ids`."""
+    table = SentOnMessage._meta.db_table
+    placeholders = ', '.join(['%s'] * len(message_ids))
+
+    sql = f"""
+        WITH RECURSIVE forwarded (id, message_parent_id, message_id) AS (
+            SELECT id, message_parent_id, message_id
+            FROM {table}
+            WHERE message_parent_id IN ({placeholders})
+            UNION
+            SELECT s.id, s.message_parent_id, s.message_id
+            FROM {table} s
+            INNER JOIN forwarded f ON s.message_parent_id = f.message_id
+        )
+        SELECT id, message_parent_id, message_id FROM forwarded
+    """
+    return sql, list(message_ids)
+
+
+def prefetch_forwarded_messages(messages):
+    """
+    Fill the `attached_messages` prefetch cache of `messages` and of every
+    message forwarded inside them, at any depth.
+
+    The whole forward graph is pulled with one recursive query, then the
+    forwarded messages are hydrated with one batched query per relation.
+    """
+    messages = list(messages)
+    if not messages:
+        return messages
+
+    loaded = {message.id: message for message in messages}
+
+    sql, params = forward_graph_query(list(loaded))
+    links = list(SentOnMessage.objects.raw(sql, params))
+
+    missing_ids = {link.message_id for link in links} - loaded.keys()
+    if missing_ids:
+        loaded.update((message.id, message) for message in load_messages(missing_ids))
+
+    children = {message_id: [] for message_id in loaded}
+    for link in links:
+        link.message = loaded[link.message_id]
+        link.message_parent = loaded[link.message_parent_id]
+        children[link.message_parent_id].append(link)
+
+    for message_id, message_links in children.items():
+        # Same order as SentOnMessage.Meta.ordering
+        message_links.sort(key=lambda link: (link.message.sent_at, link.message.id))
+
+        queryset = SentOnMessage.objects.filter(message_parent_id=message_id)
+        queryset._result_cache = message_links
+        queryset._prefetch_done = True
+
+        message = loaded[message_id]
+        if not hasattr(message, '_prefetched_objects_cache'):
+            message._prefetched_objects_cache = {}
+        message._prefetched_objects_cache['attached_messages'] = queryset
+
+    return messages
+
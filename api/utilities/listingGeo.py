@@ -0,0 +1,102 @@
+import math
+from decimal import Decimal
+
+from django.db.models import FloatField, Q, Value
+from django.db.models.functions import ASin, Cast, Cos, Least, Power, Radians, Sin, Sqrt
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Listings are bucketed in a grid of 0.1° cells, about 11 km high, numbered row by row from the south-west
+CELLS_PER_DEGREE = 10
+ROWS = 180 * CELLS_PER_DEGREE
+COLUMNS = 360 * CELLS_PER_DEGREE
+
+# Bounding boxes spanning more rows are scanned as one range of cells
+MAX_CELL_RANGES = 64
+
+
+def _row(latitude):
+    return min(math.floor((Decimal(latitude) + 90) * CELLS_PER_DEGREE), ROWS - 1)
+
+
+def _column(longitude):
+    return min(math.floor((Decimal(longitude) + 180) * CELLS_PER_DEGREE), COLUMNS - 1)
+
+
+def geo_cell(latitude, longitude):
+    """The grid cell of a location, stored in Listing.geo_cell. None without a location."""
+    if latitude is None or longitude is None:
+        return None
+    return _row(latitude) * COLUMNS + _column(longitude)
+
+
+def cell_ranges(min_lat, min_lng, max_lat, max_lng):
+    """
+    Ranges of cells covering a bounding box, one per row of the grid, or
+    one for the whole box when it spans too many rows. A box whose
+    min_lng is east of its max_lng crosses the antimeridian.
+    """
+    first_row, last_row = _row(min_lat), _row(max_lat)
+    first_column, last_column = _column(min_lng), _column(max_lng)
+
+    if min_lng <= max_lng:
+        columns = [(first_column, last_column)]
+    else:
+        columns = [(first_column, COLUMNS - 1), (0, last_column)]
+
+    if columns == [(0, COLUMNS - 1)] or (last_row - first_row + 1) * len(columns) > MAX_CELL_RANGES:
+        return [(first_row * COLUMNS, last_row * COLUMNS + COLUMNS - 1)]
+    return [(row * COLUMNS + first, row * COLUMNS + last)
+            for row in range(first_row, last_row + 1) for first, last in columns]
+
+
+def radius_bbox(latitude, longitude, radius):
+    """(min_lat, min_lng, max_lat, max_lng) of the smallest box holding every point within `radius` km."""
+    angle = radius / EARTH_RADIUS_KM
+    min_lat = max(latitude - math.degrees(angle), -90)
+    max_lat = min(latitude + math.degrees(angle), 90)
+    if min_lat == -90 or max_lat == 90:
+        # The circle holds a pole, every longitude is in reach
+        return min_lat, -180, max_lat, 180
+
+    spread = math.degrees(math.asin(min(math.sin(angle) / math.cos(math.radians(latitude)), 1)))
+    if spread >= 180:
+        return min_lat, -180, max_lat, 180
+    min_lng, max_lng = longitude - spread, longitude + spread
+    if min_lng < -180:
+        min_lng += 360
+    if max_lng > 180:
+        max_lng -= 360
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def haversine_distance(latitude, longitude):
+    """Great-circle distance in km of each listing from a point, computed by the database."""
+    lat, lng = Radians(Cast('latitude', FloatField())), Radians(Cast('longitude', FloatField()))
+    lat0, lng0 = math.radians(latitude), math.radians(longitude)
+    a = (Power(Sin((lat - Value(lat0)) / 2), 2) +
+         Value(math.cos(lat0)) * Cos(lat) * Power(Sin((lng - Value(lng0)) / 2), 2))
+    # Rounding can push `a` just past 1 for antipodes
+    return Value(2 * EARTH_RADIUS_KM) * ASin(Sqrt(Least(a, Value(1.0))))
+
+
+def filter_bbox(queryset, min_lat, min_lng, max_lat, max_lng):
+    """Listings inside a bounding box, found through the geo_cell index."""
+    min_lat, min_lng, max_lat, max_lng = (Decimal(str(value)) for value in (min_lat, min_lng, max_lat, max_lng))
+    cells = Q()
+    for first, last in cell_ranges(min_lat, min_lng, max_lat, max_lng):
+        cells |= Q(geo_cell__range=(first, last))
+
+    if min_lng <= max_lng:
+        longitudes = Q(longitude__range=(min_lng, max_lng))
+    else:
+        longitudes = Q(longitude__gte=min_lng) | Q(longitude__lte=max_lng)
+    return queryset.filter(cells, longitudes, latitude__range=(min_lat, max_lat))
+
+
+def filter_radius(queryset, latitude, longitude, radius):
+    """Listings within `radius` km of a point, nearest first, with their `distance` in km."""
+    latitude, longitude, radius = float(latitude), float(longitude), float(radius)
+    return filter_bbox(queryset, *radius_bbox(latitude, longitude, radius)).annotate(
+        distance=haversine_distance(latitude, longitude)
+    ).filter(distance__lte=radius).order_by('distance', 'id')
@@ -0,0 +1,31 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import Greatest
+
+from api.models import Listing, User
+from .messageSearch import SEARCH_CONFIG
+
+# Typo matches rank below most full-text matches, whose ranks are a few tenths
+TRIGRAM_WEIGHT = 0.1
+
+
+def update_listing_search_vectors(listings):
+    """Recompute the search vector of every listing in the `listings` queryset, in one UPDATE."""
+    seller_name = Subquery(User.objects.filter(pk=OuterRef('user_id')).values('name')[:1])
+    Listing.objects.filter(pk__in=listings.values('pk')).update(search_vector=(
+        SearchVector('title', weight='A', config=SEARCH_CONFIG) +
+        SearchVector('description', weight='B', config=SEARCH_CONFIG) +
+        SearchVector(seller_name, weight='C', config=SEARCH_CONFIG)
+    ))
+
+
+def search_listings(queryset, text):
+    """
+    Filter `queryset` down to the listings matching `text` in full-text
+    search, or with a title close enough to it to be a typo, best matches
+    first.
+    """
+    query = SearchQuery(text, search_type='websearch', config=SEARCH_CONFIG)
+    return queryset.filter(Q(search_vector=query) | Q(title__trigram_word_similar=text)).annotate(
+        rank=Greatest(SearchRank(F('search_vector'), query), TrigramWordSimilarity(text, 'title') * TRIGRAM_WEIGHT)
+    ).order_by('-rank', '-created_at', '-id')
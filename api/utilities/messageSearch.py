@@ -0,0 +1,53 @@
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+from django.db.models import F, OuterRef, Subquery
+
+from api.models import Listing, Message, MessageFile, User
+
+
+# Messages are written in several languages, so words are indexed without stemming
+SEARCH_CONFIG = 'simple'
+
+
+def related(model, field, pk_field):
+    """`field` of the `model` row a message points at through `pk_field`, as a subquery."""
+    return Subquery(model.objects.filter(pk=OuterRef(pk_field)).values(field)[:1])
+
+
+def search_document():
+    """
+    (expressions, weight) pairs indexed for a message: its own text first,
+    then the denormalized attachment text and the names of the people involved.
+    """
+    file_names = MessageFile.objects.filter(message=OuterRef('pk')).values('message') \
+        .annotate(names=StringAgg('name', ' ')).values('names')
+    return [
+        (['text'], 'A'),
+        ([related(Listing, 'title', 'attached_listing_id')], 'B'),
+        ([related(Listing, 'description', 'attached_listing_id'), related(Message, 'text', 'used_for_reply_message_id'),
+          related(User, 'name', 'from_user_id'), related(User, 'name', 'to_user_id')], 'C'),
+        ([related(Message, 'from_user__name', 'used_for_reply_message_id'),
+          related(Listing, 'user__name', 'attached_listing_id'), Subquery(file_names)], 'D'),
+    ]
+
+
+def update_search_vectors(messages):
+    """Recompute the search vector of every message in the `messages` queryset, in one UPDATE."""
+    vector = None
+    for expressions, weight in search_document():
+        part = SearchVector(*expressions, weight=weight, config=SEARCH_CONFIG)
+        vector = part if vector is None else vector + part
+    Message.objects.filter(pk__in=messages.values('pk')).update(search_vector=vector)
+
+
+def clear_search_vectors(messages):
+    messages.update(search_vector=None)
+
+
+def search_messages(queryset, text):
+    """Filter `queryset` down to the messages matching `text`, best matches first, with a highlighted `headline`."""
+    query = SearchQuery(text, search_type='websearch', config=SEARCH_CONFIG)
+    return queryset.filter(search_vector=query).annotate(
+        rank=SearchRank(F('search_vector'), query),
+        headline=SearchHeadline('text', query, config=SEARCH_CONFIG, start_sel='<b>', stop_sel='</b>')
+    ).order_by('-rank', '-sent_at', '-id')
@@ -0,0 +1,100 @@
+import asyncio
+import os
+
+from channels.db import database_sync_to_async
+from django.db import transaction
+
+from api.models import Message, MessageFile, SentOnMessage
+from .conversations import record_messages
+from .messageSearch import update_search_vectors
+from .pushNotifications import send_message_notification
+
+
+def create_messages(drafts):
+    """
+    Store messages validated by CreateMessageSerializer, given as
+    (from_user, validated_data) pairs, with one bulk insert per table.
+    """
+    with transaction.atomic():
+        messages = Message.objects.bulk_create([Message(
+            **{field: value for field, value in data.items() if field not in ('files', 'file_keys', 'attached_messages')},
+            from_user=from_user) for from_user, data in drafts])
+
+        attached_ids = {message_id for _, data in drafts for message_id in data.get('attached_messages', [])}
+        attachable = {message.id: message for message in Message.objects.filter(id__in=attached_ids)}
+
+        listToCreateFiles = []
+        listToCreateSentOnMessages = []
+        for message, (from_user, data) in zip(messages, drafts):
+            listToCreateFiles += [MessageFile(message=message, file=file, name=file.name) for file in data.get('files', [])]
+            listToCreateFiles += [MessageFile(message=message, file=key, name=os.path.basename(key))
+                                  for key in data.get('file_keys', [])]
+            # Only messages the sender can see may be forwarded
+            listToCreateSentOnMessages += [SentOnMessage(message_parent=message, message=attachable[message_id])
+                                           for message_id in data.get('attached_messages', [])
+                                           if message_id in attachable and from_user.id in (attachable[message_id].from_user_id, attachable[message_id].to_user_id)]
+
+        MessageFile.objects.bulk_create(listToCreateFiles)
+        SentOnMessage.objects.bulk_create(listToCreateSentOnMessages)
+        record_messages(messages)
+        update_search_vectors(Message.objects.filter(pk__in=[message.pk for message in messages]))
+
+        for message in messages:
+            if message.to_user.expoPushToken:
+                send_message_notification(message)
+
+    return messages
+
+
+class MessageWriter:
+    """
+    Coalesces messages sent over WebSockets into create_messages batches,
+    flushed every `flush_interval` seconds or as soon as `batch_size`
+    messages are pending.
+    """
+    flush_interval = 0.005
+    batch_size = 100
+
+    def __init__(self, flush):
+        # flush takes a list of (from_user, validated_data) pairs and returns one result per pair
+        self.flush = database_sync_to_async(flush)
+        self.pending = []
+        self.timer = None
+
+    async def write(self, from_user, data):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((from_user, data, future))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush_pending()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.flush_interval, self.flush_pending)
+
+        return await future
+
+    def flush_pending(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch):
+        try:
+            results = await self.flush([(from_user, data) for from_user, data, _ in batch])
+        except Exception as error:
+            if len(batch) > 1:
+                # The batch was rolled back as a whole, written one by one only the bad drafts fail
+                for item in batch:
+                    await self.run([item])
+                return
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
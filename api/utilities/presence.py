@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import threading
+import time
+import weakref
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.db.models import Q
+
+from api.models import Conversation
+
+
+class MemoryPresence:
+    """
+    Presence for the in-memory channel layer: live sockets of every user,
+    each with a heartbeat deadline. Only valid within one process, like the
+    layer itself. Read from the push and view threads while the event loop
+    writes, so every access holds the lock.
+    """
+    ttl = 60
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.RLock()
+
+    def live(self, user_id):
+        now = time.time()
+        with self.lock:
+            connections = {channel_name: expires_at for channel_name, expires_at
+                           in self.connections.get(user_id, {}).items() if expires_at > now}
+            if connections:
+                self.connections[user_id] = connections
+            else:
+                self.connections.pop(user_id, None)
+        return connections
+
+    async def connect(self, user_id, channel_name):
+        """Registers a socket, returns True when it's the user's only live one."""
+        with self.lock:
+            came_online = not self.live(user_id)
+            self.connections.setdefault(user_id, {})[channel_name] = time.time() + self.ttl
+        return came_online
+
+    async def heartbeat(self, user_id, channel_name):
+        with self.lock:
+            self.connections.setdefault(user_id, {})[channel_name] = time.time() + self.ttl
+
+    async def disconnect(self, user_id, channel_name):
+        """Unregisters a socket, returns True when the user has no live socket left."""
+        with self.lock:
+            self.connections.get(user_id, {}).pop(channel_name, None)
+            return not self.live(user_id)
+
+    async def online(self, user_ids):
+        return {user_id: bool(self.live(user_id)) for user_id in user_ids}
+
+
+class RedisPresence:
+    """
+    Presence stored next to the Redis channel layer, so it's shared by every
+    worker process. Each user has a sorted set of socket channel names scored
+    by their heartbeat deadline; the user is online while one of them is in
+    the future.
+    """
+    ttl = 60
+
+    def __init__(self, url):
+        self.redis = redis.asyncio.from_url(url)
+
+    @staticmethod
+    def key(user_id):
+        return f'presence:{user_id}'
+
+    async def connect(self, user_id, channel_name):
+        key = self.key(user_id)
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zcard(key)
+            pipe.zadd(key, {channel_name: now + self.ttl})
+            pipe.expire(key, self.ttl)
+            _, live, _, _ = await pipe.execute()
+        return live == 0
+
+    async def heartbeat(self, user_id, channel_name):
+        key = self.key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(key, {channel_name: time.time() + self.ttl})
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def disconnect(self, user_id, channel_name):
+        key = self.key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(key, channel_name)
+            pipe.zremrangebyscore(key, '-inf', time.time())
+            pipe.zcard(key)
+            _, _, live = await pipe.execute()
+        return live == 0
+
+    async def online(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self.key(user_id), now, '+inf')
+            counts = await pipe.execute()
+        return {user_id: count > 0 for user_id, count in zip(user_ids, counts)}
+
+
+def redis_url(host):
+    if isinstance(host, str):
+        return host
+    host, port = host
+    return f'redis://{host}:{port}'
+
+
+presences = weakref.WeakKeyDictionary()
+memory_presence = MemoryPresence()
+
+
+def get_presence():
+    """Presence backend matching the default channel layer. Redis clients are bound to the running loop."""
+    layer = settings.CHANNEL_LAYERS['default']
+    if 'Redis' not in layer['BACKEND']:
+        return memory_presence
+
+    loop = asyncio.get_running_loop()
+    if loop not in presences:
+        presences[loop] = RedisPresence(redis_url(layer['CONFIG']['hosts'][0]))
+    return presences[loop]
+
+
+async def online_users(user_ids):
+    return await get_presence().online(user_ids)
+
+
+@functools.lru_cache(maxsize=None)
+def sync_redis(url):
+    return redis.Redis.from_url(url)
+
+
+def sync_online_users(user_ids):
+    """
+    online_users for sync views. A blocking client shared by the process,
+    instead of an asyncio client left behind in a new event loop per request.
+    """
+    layer = settings.CHANNEL_LAYERS['default']
+    if 'Redis' not in layer['BACKEND']:
+        return {user_id: bool(memory_presence.live(user_id)) for user_id in user_ids}
+
+    user_ids = list(user_ids)
+    now = time.time()
+    with sync_redis(redis_url(layer['CONFIG']['hosts'][0])).pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.zcount(RedisPresence.key(user_id), now, '+inf')
+        counts = pipe.execute()
+    return {user_id: count > 0 for user_id, count in zip(user_ids, counts)}
+
+
+def conversation_partners(user_id):
+    """Ids of every user `user_id` has a conversation with."""
+    pairs = Conversation.objects.filter(Q(first_user_id=user_id) | Q(second_user_id=user_id)) \
+        .values_list('first_user_id', 'second_user_id')
+    return {second_user_id if first_user_id == user_id else first_user_id for first_user_id, second_user_id in pairs}
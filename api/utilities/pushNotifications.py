@@ -1,21 +1,334 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+
+import requests
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
 from exponent_server_sdk import (
     DeviceNotRegisteredError,
+    MessageRateExceededError,
     PushClient,
     PushMessage,
     PushServerError,
     PushTicketError,
 )
-from requests.exceptions import ConnectionError, HTTPError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+from api.models import User
+from .presence import online_users
+from .userCache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Every push ends up once in sent, failed or skipped. Undelivered ones are the sent ones whose receipt reported an error.
+PUSH_COUNTERS = ['sent', 'failed', 'skipped', 'undelivered', 'pruned']
+
+
+def count(name, value=1):
+    """Adds to a push counter, kept in the shared cache so every worker process adds to the same totals."""
+    if value:
+        key = f'push-counter:{name}'
+        cache.add(key, 0, None)
+        cache.incr(key, value)
+
+
+def push_counters():
+    counters = cache.get_many([f'push-counter:{name}' for name in PUSH_COUNTERS])
+    return {name: counters.get(f'push-counter:{name}', 0) for name in PUSH_COUNTERS}
+
+
+def is_push_token(token):
+    return isinstance(token, str) and token.startswith(('ExponentPushToken[', 'ExpoPushToken[')) and token.endswith(']')
+
+
+# A new message for a push, coalesced with others from the same sender before sending
+Notification = namedtuple('Notification', ['recipient_id', 'sender_id', 'token', 'title', 'body'])
+
+
+class PendingNotifications:
+    """Notifications of one (recipient, sender) pair waiting for their coalescing window to end."""
+
+    def __init__(self, notification, due):
+        self.notification = notification
+        self.count = 1
+        self.due = due
+
+    def add(self, notification):
+        # The newest token and sender name win
+        self.notification = notification
+        self.count += 1
+
+    def push_message(self):
+        notification = self.notification
+        body = notification.body if self.count == 1 else f'{self.count} new messages'
+        return PushMessage(to=notification.token,
+                           title=notification.title,
+                           body=body,
+                           sound='default',
+                           data={'from_user': notification.sender_id, 'count': self.count})
+
+
+def is_retryable(error):
+    """Whether a failed Expo request is worth sending again: network errors, throttling and server errors."""
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and (response.status_code == 429 or response.status_code >= 500)
+
+
+class PushQueue:
+    """
+    Expo push notifications sent by a background thread, off the request
+    and out of its transaction. Queued messages are published together
+    with `publish_multiple` over one pooled HTTP session, failed requests
+    and throttled messages are retried with exponential backoff, and
+    receipts are checked once Expo has had time to deliver.
+
+    New message notifications are coalesced per (recipient, sender) for
+    `coalesce_window` seconds into one "N new messages" push, dropped when
+    the recipient has the chat open, and capped at `rate_limit` pushes per
+    recipient every `rate_period` seconds; notifications over the cap keep
+    coalescing until the recipient is under it again.
+
+    Tokens Expo reports as no longer registered, and malformed ones, are
+    cleared from their users in one update per round.
+    """
+    batch_size = PushClient.DEFAULT_MAX_MESSAGE_COUNT
+    flush_interval = 0.2
+    poll_interval = 1
+    timeout = 10
+    max_attempts = 5
+    backoff = 1
+    receipt_delay = 15 * 60
+    coalesce_window = 3
+    rate_limit = 5
+    rate_period = 60
+
+    def __init__(self, host=None):
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.headers.update({
+            'accept': 'application/json',
+            'accept-encoding': 'gzip, deflate',
+            'content-type': 'application/json',
+        })
+        self.client = PushClient(host=host, session=self.session, timeout=self.timeout)
+
+        self.queue = queue.Queue()
+        # (due, push_message, attempt) of messages to publish, including retries
+        self.scheduled = []
+        self.tickets = []
+        self.pending = {}
+        self.sent = defaultdict(deque)
+        self.dead_tokens = set()
+        self.loop = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def enqueue(self, item):
+        """Queues a PushMessage, or a Notification to coalesce."""
+        self.queue.put(item)
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='push-queue', daemon=True)
+                self.thread.start()
+
+    def enqueue_on_commit(self, item):
+        transaction.on_commit(lambda: self.enqueue(item))
+
+    def stop(self):
+        """Ends the worker after its current round, dropping whatever is still pending."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        # Presence backends are async, the worker keeps one loop for their clients
+        self.loop = asyncio.new_event_loop()
+        while not self.stopping.is_set():
+            try:
+                batch = self.next_batch()
+                if batch:
+                    self.publish(batch)
+                self.check_receipts()
+                self.prune_tokens()
+            except Exception:
+                # Keep the worker alive, a bad message must not stop every later one
+                logger.exception('Push queue round failed')
+        connection.close()
+        self.loop.close()
+
+    def next_batch(self):
+        self.collect()
+
+        now = time.monotonic()
+        batch = [(push_message, attempt) for due, push_message, attempt in self.scheduled if due <= now]
+        self.scheduled = [item for item in self.scheduled if item[0] > now]
+        batch += [(push_message, 1) for push_message in self.due_notifications(now)]
+        return batch
+
+    def collect(self):
+        """Waits for queued items until something is due, then takes whatever else arrives within `flush_interval`."""
+        now = time.monotonic()
+        due = [due for due, _, _ in self.scheduled] + [pending.due for pending in self.pending.values()]
+        timeout = min([self.poll_interval] + [max(at - now, 0) for at in due])
+
+        try:
+            self.add(self.queue.get(timeout=timeout))
+            deadline = time.monotonic() + self.flush_interval
+            for _ in range(self.batch_size - 1):
+                self.add(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+            pass
+
+    def add(self, item):
+        if not isinstance(item, Notification):
+            self.scheduled.append((0, item, 1))
+            return
+
+        key = (item.recipient_id, item.sender_id)
+        if key in self.pending:
+            self.pending[key].add(item)
+        else:
+            self.pending[key] = PendingNotifications(item, time.monotonic() + self.coalesce_window)
+
+    def due_notifications(self, now):
+        due = {key: pending for key, pending in self.pending.items() if pending.due <= now}
+        if not due:
+            return []
+
+        online = self.online({recipient_id for recipient_id, _ in due})
+        push_messages = []
+        for key, pending in due.items():
+            recipient_id = key[0]
+            if online.get(recipient_id):
+                count('skipped', pending.count)
+                del self.pending[key]
+                continue
+
+            sent = self.sent[recipient_id]
+            while sent and sent[0] <= now - self.rate_period:
+                sent.popleft()
+            if len(sent) >= self.rate_limit:
+                pending.due = sent[0] + self.rate_period
+                continue
+
+            sent.append(now)
+            del self.pending[key]
+            push_messages.append(pending.push_message())
+
+        for recipient_id in [recipient_id for recipient_id, sent in self.sent.items() if not sent]:
+            del self.sent[recipient_id]
+        return push_messages
+
+    def online(self, user_ids):
+        try:
+            return self.loop.run_until_complete(online_users(user_ids))
+        except Exception as error:
+            # Better an extra push than a missed one
+            logger.warning('Presence unavailable, pushing to every recipient: %s', error)
+            return {}
+
+    def retry(self, items, error):
+        for push_message, attempt in items:
+            if attempt >= self.max_attempts:
+                count('failed')
+                logger.error('Push notification to %s dropped after %d attempts: %s', push_message.to, attempt, error)
+            else:
+                self.scheduled.append((time.monotonic() + self.backoff * 2 ** (attempt - 1), push_message, attempt + 1))
+
+    def publish(self, batch):
+        malformed = {push_message.to for push_message, _ in batch if not is_push_token(push_message.to)}
+        if malformed:
+            count('failed', len([push_message for push_message, _ in batch if push_message.to in malformed]))
+            self.dead_tokens |= malformed
+            batch = [(push_message, attempt) for push_message, attempt in batch if push_message.to not in malformed]
+            if not batch:
+                return
+
+        try:
+            tickets = self.client.publish_multiple([push_message for push_message, _ in batch])
+        except (PushServerError, ConnectionError, HTTPError, Timeout) as error:
+            if is_retryable(error):
+                self.retry(batch, error)
+            else:
+                count('failed', len(batch))
+                logger.error('Push notifications rejected by Expo: %s', error)
+            return
+
+        check_at = time.monotonic() + self.receipt_delay
+        for (push_message, attempt), ticket in zip(batch, tickets):
+            try:
+                ticket.validate_response()
+            except MessageRateExceededError as error:
+                self.retry([(push_message, attempt)], error)
+            except PushTicketError as error:
+                self.ticket_failed(ticket, error)
+            else:
+                count('sent')
+                self.tickets.append((check_at, ticket))
+
+    def check_receipts(self):
+        now = time.monotonic()
+        due = [ticket for check_at, ticket in self.tickets if check_at <= now]
+        if not due:
+            return
+
+        try:
+            receipts = self.client.check_receipts_multiple(due)
+        except (PushServerError, ConnectionError, HTTPError, Timeout) as error:
+            # Tried again on a later round, Expo keeps receipts for a day
+            logger.warning('Push receipts could not be fetched: %s', error)
+            self.tickets = [(now + self.backoff * 60, ticket) if check_at <= now else (check_at, ticket)
+                            for check_at, ticket in self.tickets]
+            return
+
+        self.tickets = [(check_at, ticket) for check_at, ticket in self.tickets if check_at > now]
+        tickets = {ticket.id: ticket for ticket in due}
+        for receipt in receipts:
+            try:
+                receipt.validate_response()
+            except PushTicketError as error:
+                self.ticket_failed(tickets.get(receipt.id), error, 'undelivered')
+
+    def ticket_failed(self, ticket, error, counter='failed'):
+        count(counter)
+        to = ticket.push_message.to if ticket is not None else None
+        if isinstance(error, DeviceNotRegisteredError):
+            if to is not None:
+                self.dead_tokens.add(to)
+        else:
+            logger.error('Push notification to %s failed: %s', to, error)
+
+    def prune_tokens(self):
+        if not self.dead_tokens:
+            return
+
+        tokens, self.dead_tokens = self.dead_tokens, set()
+        # The worker thread keeps its own connection, drop it if it went stale while idle
+        close_old_connections()
+        user_ids = list(User.objects.filter(expoPushToken__in=tokens).values_list('id', flat=True))
+        User.objects.filter(id__in=user_ids, expoPushToken__in=tokens).update(expoPushToken=None)
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        count('pruned', len(user_ids))
+
 
+push_queue = PushQueue()
 
-# Basic arguments. You should extend this function with the push features you
-# want to use, or simply pass in a `PushMessage` object.
-def send_push_message(token, title, body, extra=None):
-    response = PushClient().publish(
-        PushMessage(to=token,
-                    title=title,
-                    body=body,
-                    sound='default',
-                    data=extra))
 
-    response.validate_response()
\ No newline at end of file
+def send_message_notification(message):
+    """Queues the push for a new message, coalesced with the sender's other recent messages to the same user."""
+    push_queue.enqueue_on_commit(
+        Notification(recipient_id=message.to_user_id,
+                     sender_id=message.from_user_id,
+                     token=message.to_user.expoPushToken,
+                     title=message.from_user.name,
+                     body=message.text))
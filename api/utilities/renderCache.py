@@ -0,0 +1,102 @@
+import hashlib
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+class RenderCache:
+    """
+    Rendered JSON of messages, which almost never change once sent. A
+    fragment is keyed by the message id and the versions of everything it
+    shows: the message itself, its reply and forwarded messages, users and
+    listings. Changing any of them bumps its version, so every fragment
+    showing it is missed from then on and expires on its own.
+    """
+    timeout = 60 * 60 * 24
+    # Outlives the fragments using a version. An expired version restarts, missing them as an eviction does.
+    version_timeout = timeout * 2
+    # Bumped when the serializers change what a message renders to, so older fragments are missed
+    schema = 2
+
+    def version_key(self, kind, id):
+        return f'render-version:{kind}:{id}'
+
+    def invalidate(self, kind, ids):
+        """Bumps the versions of `kind` objects once the current transaction commits."""
+        keys = [self.version_key(kind, id) for id in ids]
+        if keys:
+            transaction.on_commit(lambda: cache.set_many({key: uuid.uuid4().hex for key in keys}, self.version_timeout))
+
+    def versions(self, dependencies):
+        keys = {dependency: self.version_key(*dependency) for dependency in dependencies}
+        versions = cache.get_many(keys.values())
+
+        # An evicted version can't be told apart from an old one, start a new one instead
+        missing = {key: uuid.uuid4().hex for key in keys.values() if key not in versions}
+        if missing:
+            cache.set_many(missing, self.version_timeout)
+            versions.update(missing)
+        return {dependency: versions[key] for dependency, key in keys.items()}
+
+    def fragment_key(self, message, dependencies, versions, prefix):
+        digest = hashlib.md5(prefix.encode())
+        for dependency in sorted(dependencies):
+            digest.update(f'{dependency[0]}:{dependency[1]}:{versions[dependency]};'.encode())
+        return f'render:message:{self.schema}:{message.id}:{digest.hexdigest()}'
+
+    def render(self, messages, serialize, reload, prefix=''):
+        """
+        Fragments of `messages`, taken from the cache in one multi-get.
+        Misses are reloaded by `reload` from their ids only once their
+        versions are read, so a change committing after the first load
+        can't be stored under the version it bumped. They are then rendered
+        together by `serialize` and stored.
+        """
+        dependencies = [message_dependencies(message) for message in messages]
+        versions = self.versions(set().union(*dependencies))
+        keys = [self.fragment_key(message, shown, versions, prefix) for message, shown in zip(messages, dependencies)]
+
+        fragments = cache.get_many(keys)
+        misses = {message.id: (message, key, shown)
+                  for message, key, shown in zip(messages, keys, dependencies) if key not in fragments}
+        if misses:
+            reloaded = {message.id: message for message in reload(list(misses))}
+            # A message deleted since is rendered as it was loaded, and left out of the cache
+            rendering = [reloaded.get(id, message) for id, (message, _, _) in misses.items()]
+            for message, fragment in zip(rendering, serialize(rendering)):
+                _, key, shown = misses[message.id]
+                fragments[key] = fragment
+                # One changed since shows other objects than the key holds versions of
+                if message_dependencies(message) != shown or message.id not in reloaded:
+                    misses.pop(message.id)
+            cache.set_many({key: fragments[key] for _, key, _ in misses.values()}, self.timeout)
+        return [fragments[key] for key in keys]
+
+
+render_cache = RenderCache()
+
+
+def listing_dependencies(listing):
+    return {('listing', listing.id), ('user', listing.user_id)}
+
+
+def message_dependencies(message, seen=None):
+    """Everything shown by a message serialized with MessageSerializer, as (kind, id) pairs."""
+    seen = set() if seen is None else seen
+    seen.add(message.id)
+
+    dependencies = {('message', message.id), ('user', message.from_user_id), ('user', message.to_user_id)}
+    if message.attached_listing_id is not None:
+        dependencies |= listing_dependencies(message.attached_listing)
+
+    reply = message.used_for_reply_message
+    if reply is not None:
+        dependencies |= {('message', reply.id), ('user', reply.from_user_id)}
+        if reply.attached_listing_id is not None:
+            dependencies |= listing_dependencies(reply.attached_listing)
+
+    for sent_on_message in message.attached_messages.all():
+        if sent_on_message.message.id not in seen:
+            dependencies |= message_dependencies(sent_on_message.message, seen)
+    return dependencies
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from channels.layers import get_channel_layer
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from imagekit.utils import generate, suggest_extension
+
+from .eventLog import send_to_user
+from .renderCache import render_cache
+from .userCache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Thumbnail fields of every model, by the image field they are made from
+THUMBNAILS = {
+    'api.ListingImage': ('image', ['thumbnail_card', 'thumbnail_detail']),
+    'api.User': ('avatar', ['avatar_thumbnail_sm']),
+}
+
+
+def render_thumbnails(model_label, source_name, data):
+    """
+    Runs the imagekit specs of a model's thumbnail fields on the source
+    image, in a pool process. Returns (field name, file name, bytes) of
+    every thumbnail.
+    """
+    model = apps.get_model(model_label)
+    _, thumbnail_fields = THUMBNAILS[model_label]
+    thumbnails = []
+    for field_name in thumbnail_fields:
+        field = model._meta.get_field(field_name)
+        spec = field.get_spec(source=ContentFile(data, name=source_name))
+        content = generate(spec)
+        file_name = os.path.splitext(os.path.basename(source_name))[0] + suggest_extension(source_name, spec.format)
+        thumbnails.append((field_name, file_name, content.read()))
+    return thumbnails
+
+
+class ThumbnailPipeline:
+    """
+    Generates thumbnails after the rows holding their source images commit,
+    so requests return with the thumbnail fields still empty, pending.
+    Threads download sources and store results, and the image work runs
+    in a process pool spread across cores. Once a row's thumbnails are
+    stored, its owner gets a `thumbnails` event on their sockets, sent from
+    one event loop the pipeline keeps running for its Redis clients.
+    """
+    threads = 4
+
+    def __init__(self, processes=None):
+        self.processes = processes or min(os.cpu_count() or 1, 4)
+        self.process_pool = None
+        self.thread_pool = None
+        self.loop = None
+
+    def start(self):
+        if self.process_pool is None:
+            # Spawned, forking a server with threads running isn't safe. Workers load Django for the specs.
+            self.process_pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=django.setup)
+            self.thread_pool = ThreadPoolExecutor(self.threads, thread_name_prefix='thumbnails')
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name='thumbnails-events', daemon=True).start()
+
+    def submit(self, model_label, pks):
+        self.start()
+        return [self.thread_pool.submit(self.generate, model_label, pk) for pk in pks]
+
+    def submit_on_commit(self, model_label, pks):
+        if pks:
+            transaction.on_commit(lambda: self.submit(model_label, pks))
+
+    def missing(self, model_label):
+        """Rows with a source image but not all of its thumbnails, pending or left by a lost job."""
+        source_field, thumbnail_fields = THUMBNAILS[model_label]
+        missing = Q()
+        for field_name in thumbnail_fields:
+            missing |= Q(**{f'{field_name}__isnull': True}) | Q(**{field_name: ''})
+        return apps.get_model(model_label).objects.exclude(**{f'{source_field}__isnull': True}) \
+            .exclude(**{source_field: ''}).filter(missing)
+
+    def generate(self, model_label, pk):
+        try:
+            close_old_connections()
+            return self.make_thumbnails(apps.get_model(model_label), model_label, pk)
+        except Exception:
+            logger.exception('Thumbnails of %s %s failed', model_label, pk)
+        finally:
+            close_old_connections()
+
+    def make_thumbnails(self, model, model_label, pk):
+        source_field, _ = THUMBNAILS[model_label]
+        instance = model.objects.filter(pk=pk).first()
+        source = getattr(instance, source_field, None)
+        if not source:
+            return None
+
+        names = self.existing_thumbnails(model, model_label, instance)
+        generated = names is None
+        if generated:
+            with source.open('rb'):
+                data = source.read()
+            thumbnails = self.process_pool.submit(render_thumbnails, model_label, source.name, data).result()
+
+            names = {}
+            for field_name, file_name, content in thumbnails:
+                field = model._meta.get_field(field_name)
+                names[field_name] = field.storage.save(field.generate_filename(instance, file_name), ContentFile(content),
+                                                      max_length=field.max_length)
+
+        # Only if the source is still the one the thumbnails were made from
+        if not model.objects.filter(pk=pk, **{source_field: source.name}).update(**names):
+            for field_name, name in names.items() if generated else ():
+                model._meta.get_field(field_name).storage.delete(name)
+            return None
+
+        for field_name, name in names.items():
+            setattr(instance, field_name, name)
+        self.publish(model_label, instance)
+        return names
+
+    def existing_thumbnails(self, model, model_label, instance):
+        """Thumbnails another row already has for the same content-addressed source, shared instead of made again."""
+        source_field, thumbnail_fields = THUMBNAILS[model_label]
+        done = model.objects.filter(**{source_field: getattr(instance, source_field).name}).exclude(pk=instance.pk)
+        for field_name in thumbnail_fields:
+            done = done.exclude(**{f'{field_name}__isnull': True}).exclude(**{field_name: ''})
+        return done.values(*thumbnail_fields).first()
+
+    def publish(self, model_label, instance):
+        # Updated in bulk, so no signal drops the cached versions
+        if model_label == 'api.User':
+            user_cache.invalidate(instance.pk)
+            render_cache.invalidate('user', [instance.pk])
+            user_id, event = instance.pk, {'kind': 'avatar', 'id': instance.pk}
+        else:
+            render_cache.invalidate('listing', [instance.listing_id])
+            user_id = instance.listing.user_id
+            event = {'kind': 'listingImage', 'id': instance.pk, 'listing': instance.listing_id}
+
+        _, thumbnail_fields = THUMBNAILS[model_label]
+        event['thumbnails'] = {field_name: getattr(instance, field_name).url for field_name in thumbnail_fields}
+        asyncio.run_coroutine_threadsafe(
+            send_to_user(get_channel_layer(), user_id, dict(event, type='thumbnails_event')), self.loop).result()
+
+
+thumbnail_pipeline = ThumbnailPipeline()
@@ -0,0 +1,61 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+
+
+class UserCache:
+    """
+    Per-process LRU of users by id, with a short TTL, so reconnect storms and
+    bursts of authenticated requests don't each cost a SELECT on the user table.
+    Users are copied in and out so callers never share an instance.
+    """
+    ttl = 30
+    max_size = 10000
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                del self.entries[user_id]
+                return None
+
+            self.entries.move_to_end(user_id)
+        return copy.copy(user)
+
+    def set(self, user_id, user):
+        user = copy.copy(user)
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + self.ttl, user)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+user_cache = UserCache()
+
+
+def load_user(user_id):
+    """Reads a user from the database into the cache. Returns None if it doesn't exist."""
+    user = get_user_model().objects.filter(id=user_id).first()
+    if user is not None:
+        user_cache.set(user_id, user)
+    return user
@@ -1,10 +1,9 @@
-import operator
-from django.db.models import Q, F, CharField
-from django.db.models.functions import Greatest, Least, Cast, Concat
+from django.db.models import Prefetch, Q
 from django.shortcuts import get_object_or_404, render
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework import permissions
 from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.views import APIView
@@ -13,12 +12,17 @@ from rest_framework.viewsets import ModelViewSet
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django_filters.rest_framework import DjangoFilterBackend
 from api import serializers
-from api.filters import ListingFilter
-from api.pagination import DefaultPagination, MessagePagination
+from api.filters import ListingFilter, ListingSearchFilter
+from api.pagination import DefaultPagination, MessageCursorPagination, MessagePagination
 from api.permissions import IsUserOrReadOnly, IsObjInListingOwnerOrReadOnly, IsOwnerOrReadOnly, IsMessageOwnerOrReadOnly
 
-from api.serializers import CategorySerializer, ChatMessageSerializer, CreateListingSerializer, CreateMessageSerializer, DeleteForAllMessageSerializer, DeleteForMeMessageSerializer, ListingImageSerializer, ListingSerializer, CustomTokenObtainPairSerializer, MarkAsReadMessageSerializer, MessageSerializer, UpdateMessageSerializer, UserCreateSerializer, UserExpoTokenSerializer, UserSerializer
-from .models import Category, Listing, ListingImage, Message, User
+from api.serializers import CategorySerializer, ChatMessageSerializer, CreateListingSerializer, CreateMessageSerializer, DeleteForAllMessageSerializer, DeleteForMeMessageSerializer, ListingImageSerializer, ListingSerializer, CustomTokenObtainPairSerializer, MarkAsReadMessageSerializer, MessageSearchSerializer, MessageSerializer, DirectUploadSerializer, PresignUploadSerializer, UpdateMessageSerializer, UserCreateSerializer, UserExpoTokenSerializer, UserSerializer
+from api.utilities.conversations import visible_messages_q
+from api.utilities.forwardedMessages import MESSAGE_PREFETCH_RELATED, MESSAGE_SELECT_RELATED, prefetch_forwarded_messages
+from api.utilities.messageSearch import search_messages
+from api.utilities.presence import conversation_partners, sync_online_users
+from api.utilities.pushNotifications import push_counters
+from .models import Category, ConversationMember, Listing, ListingImage, Message, User
 
 
 class CustomTokenObtainPairView(TokenObtainPairView):
@@ -51,12 +55,12 @@ class CategoryViewSet(ModelViewSet):
 
 class ListingViewSet(ModelViewSet):
     permission_classes = [IsOwnerOrReadOnly, IsAuthenticated]
+    # The search vector is only read by the database
     queryset = Listing.objects.prefetch_related(
-        'images').select_related('user').order_by('-created_at')
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+        'images').select_related('user').defer('search_vector').order_by('-created_at')
+    filter_backends = [DjangoFilterBackend, ListingSearchFilter, OrderingFilter]
     filterset_class = ListingFilter
     pagination_class = DefaultPagination
-    search_fields = ['title', 'description', 'user__name']
     ordering_fields = ['price', 'created_at']
 
     def get_serializer_context(self):
@@ -69,7 +73,7 @@ class ListingViewSet(ModelViewSet):
 
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def my(self, request):
-        recent_listings = Listing.objects.prefetch_related('images').filter(
+        recent_listings = Listing.objects.prefetch_related('images').defer('search_vector').filter(
             user=request.user).order_by('-created_at')
 
         recent_listings = self.filter_queryset(recent_listings)
@@ -95,32 +99,27 @@ class ListingImageViewSet(ModelViewSet):
 
 
 def prefRelMessages(user_id):
-    resultquery = ((Q(from_user__id=user_id) & Q(is_deleted_for_from_user=False)) | (
-            Q(to_user__id=user_id) & Q(is_deleted_for_to_user=False)))
+    resultquery = visible_messages_q(user_id)
 
-    queryset = Message.objects.filter(resultquery)
-    prefetch_fields = ['files', 'from_user', 'to_user', 'attached_listing__images',
-                       'used_for_reply_message__files', 'used_for_reply_message__from_user', 'used_for_reply_message__attached_listing__images']
-    select_fields = ['from_user', 'to_user', 'used_for_reply_message__from_user']
-    base_lookup = "attached_messages__message"
-    previous = ""
+    # Forwarded messages are attached by prefetch_forwarded_messages once the
+    # page is known, so only the first level is prefetched here.
+    return Message.objects.filter(resultquery).select_related(
+        *MESSAGE_SELECT_RELATED).prefetch_related(*MESSAGE_PREFETCH_RELATED)
 
 
-    queryset = queryset.select_related(*select_fields)
-    for attached in range(100):
-        prefetch_lookups = [
-            previous + prefetch_field for prefetch_field in prefetch_fields]
-
-        queryset = queryset.prefetch_related(*prefetch_lookups)
-
-        previous += base_lookup + "__"
-
-    return queryset
+def chat_last_messages(members):
+    messages = []
+    for member in members:
+        member.last_message.unread_count = member.unread_count
+        messages.append(member.last_message)
+    return messages
 
 
 class MessageViewSet(ModelViewSet):
     permission_classes = [IsMessageOwnerOrReadOnly, IsAuthenticated]
     pagination_class = MessagePagination
+    cursor_pagination_class = MessageCursorPagination
+    cursor_pagination_actions = ['list', 'chatView']
     filter_backends = [SearchFilter]
     search_fields = ['text', 'from_user__name', 'to_user__name', 'used_for_reply_message__text',
                      'used_for_reply_message__from_user__name',
@@ -133,6 +132,21 @@ class MessageViewSet(ModelViewSet):
     def get_serializer_context(self):
         return {"from_user": self.request.user, "request": self.request}
 
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.action in self.cursor_pagination_actions and self.cursor_pagination_class.is_requested(self.request):
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_object(self):
+        instance = super().get_object()
+        if self.action == 'retrieve':
+            prefetch_forwarded_messages([instance])
+        return instance
+
     def get_serializer_class(self):
         if self.action == 'markRead':
             return MarkAsReadMessageSerializer
@@ -142,6 +156,8 @@ class MessageViewSet(ModelViewSet):
             return DeleteForAllMessageSerializer
         if self.action == 'chatsView':
             return ChatMessageSerializer
+        if self.action == 'search':
+            return MessageSearchSerializer
         if self.request.method in permissions.SAFE_METHODS:
             return MessageSerializer
         if self.request.method == 'PUT':
@@ -175,7 +191,10 @@ class MessageViewSet(ModelViewSet):
     def chatView(self, request):
         ids = request.GET.get('user__in', None)
         if ids:
-            queryset = self.get_queryset().filter(Q(from_user__id__in=ids) | Q(to_user__id__in=ids))
+            ids = [id for id in ids.split(',') if id.isdigit()]
+            # Spelled as explicit pairs so the planner can use message_pair_idx
+            queryset = self.get_queryset().filter(Q(from_user=request.user, to_user__id__in=ids) |
+                                                  Q(from_user__id__in=ids, to_user=request.user))
             queryset = self.filter_queryset(queryset)
 
             page = self.paginate_queryset(queryset)
@@ -189,22 +208,48 @@ class MessageViewSet(ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def chatsView(self, request):
-        queryset = self.get_queryset().annotate(slug=Concat(Cast(Least('from_user', 'to_user'),
-                                                                 output_field=CharField()), Cast(Greatest('from_user', 'to_user'), output_field=CharField()))).order_by('slug', '-sent_at').distinct('slug')
-        self.search_fields = ['from_user__name', 'to_user__name']
+        last_messages = Message.objects.select_related(
+            *MESSAGE_SELECT_RELATED).prefetch_related(*MESSAGE_PREFETCH_RELATED)
+        queryset = ConversationMember.objects.filter(user=request.user, last_message__isnull=False) \
+            .prefetch_related(Prefetch('last_message', queryset=last_messages)) \
+            .order_by('-last_message_at', '-id')
+        self.search_fields = ['conversation__first_user__name', 'conversation__second_user__name']
         queryset = self.filter_queryset(queryset)
 
-        queryset = sorted(queryset, key=operator.attrgetter(
-            'sent_at'), reverse=True)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(chat_last_messages(page), many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = self.get_serializer(chat_last_messages(queryset), many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        text = request.GET.get('q', None)
+        if not text:
+            return Response({}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = search_messages(self.get_queryset(), text)
 
         page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
-            
+
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['get'])
+    def unread(self, request):
+        counts = ConversationMember.objects.filter(user=request.user, unread_count__gt=0) \
+            .values_list('conversation__first_user_id', 'conversation__second_user_id', 'unread_count')
+
+        conversations = [{"user": second_user_id if first_user_id == request.user.id else first_user_id, "unread_count": unread_count}
+                         for first_user_id, second_user_id, unread_count in counts]
+
+        return Response({"total": sum(conversation['unread_count'] for conversation in conversations), "conversations": conversations}, status=status.HTTP_200_OK)
+
 
 class ExpoPushTokenView(APIView):
     permission_classes = [IsAuthenticated]
@@ -224,5 +269,42 @@ class ExpoPushTokenView(APIView):
         serializer.save()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+class PresenceView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        ids = request.GET.get('users', '')
+        partners = conversation_partners(request.user.id)
+        user_ids = [int(id) for id in ids.split(',') if id.isdigit() and int(id) in partners]
+
+        online = sync_online_users(user_ids)
+        return Response({"users": online}, status=status.HTTP_200_OK)
+
+class PushStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(push_counters(), status=status.HTTP_200_OK)
+
+class PresignUploadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = PresignUploadSerializer(data=request.data, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save(), status=status.HTTP_201_CREATED)
+
+class UploadView(APIView):
+    """Stand-in for S3 presigned posts when files are stored locally, the signed token is the credential."""
+    permission_classes = [AllowAny]
+    authentication_classes = []
+    parser_classes = [MultiPartParser]
+
+    def post(self, request):
+        serializer = DirectUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 def webSocketTester(request):
     return render(request, 'api/webSocketTester.html')
\ No newline at end of file